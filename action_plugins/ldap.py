@@ -36,8 +36,9 @@ class ActionModule(object):
 
         options = self._load_options(module_args, complex_args)
         source = options.get('src', None)
+        remote_src = utils.boolean(options.get('remote_src', False))
 
-        if source:
+        if source and not remote_src:
             if source.endswith('.j2'):
                 filepath = self._resolve_file_path(source, 'templates', inject)
                 content = template.template_from_file(
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# (c) 2015, Jakub Jirutka <jakub@jirutka.cz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from ansible import utils
+from ansible.runner.return_data import ReturnData
+from ansible.utils import plugins
+
+import fcntl
+import hashlib
+import imp
+import os
+import time
+from os import path
+
+# Options of the file module that are passed to the copy module.
+FILE_OPTIONS = ['mode', 'owner', 'group', 'seuser', 'serole', 'setype', 'selevel']
+
+
+class ActionModule(object):
+    ''' Downloads the artifact on the controller and copies it to the hosts.
+
+    When the option controller_download is not enabled, the module is just
+    executed on the hosts as usual.
+
+    Otherwise the artifact is downloaded only once for all the hosts into
+    a cache on the controller (concurrent forks wait for the one that
+    downloads it) and then copied to the hosts whose file has a different
+    checksum. At most max_transfers hosts are copied to at once.
+    '''
+
+    TRANSFERS_FILES = True
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def run(self, conn, tmp, module_name, module_args, inject, complex_args=None, **kwargs):
+        ''' Handler for downloading on the controller. '''
+
+        options = self._load_options(module_args, complex_args)
+
+        if not utils.boolean(options.get('controller_download', False)):
+            if self.runner.noop_on_check(inject):
+                module_args += " CHECKMODE=True"
+            return self.runner._execute_module(
+                conn, tmp, 'mvn_get', module_args, inject=inject, complex_args=complex_args)
+
+        if options.get('artifacts') or options.get('extract_to') \
+                or utils.boolean(options.get('resolve_dependencies', False)):
+            return self._fail(conn, "controller_download supports only a single artifact")
+        if not options.get('dest'):
+            return self._fail(conn, "missing required arguments: dest")
+
+        mvn_get = self._load_module()
+        params = self._module_params(mvn_get, options)
+        # the cache on the controller can't be disabled, forks share the download through it
+        cache_dir = params['cache_dir'] or mvn_get.ARGUMENT_SPEC['cache_dir']['default']
+        cache_dir = path.join(path.expanduser(cache_dir), 'controller')
+        try:
+            artifact = mvn_get.make_artifact(params, params)
+            if self.runner.noop_on_check(inject):
+                source, result = None, self._checksum(mvn_get, artifact, params, cache_dir)
+            else:
+                source, result = self._fetch(mvn_get, artifact, params, cache_dir)
+        except mvn_get.Error, e:
+            return self._fail(conn, str(e))
+        except (IOError, OSError), e:
+            return self._fail(conn, "Failed to download the artifact on controller: %s" % e)
+
+        return self._push(conn, tmp, source, artifact.filename(), params, cache_dir, result, inject)
+
+    def _fetch(self, mvn_get, artifact, params, cache_dir):
+        ''' Downloads the artifact into the cache on the controller, unless
+        it's there already.
+
+        :returns: tuple of the path of the cached file and the result of the
+            download
+        '''
+        lock = self._flock(path.join(cache_dir, 'locks', hash_name(str(artifact))), fcntl.LOCK_EX)
+        try:
+            dw = mvn_get.make_downloader(params, cache_dir)
+            try:
+                # Released versions never change, so they are not checked again.
+                if not mvn_get.is_version_spec(artifact.version) and not artifact.is_snapshot():
+                    source = path.join(cache_dir, 'files', artifact.path(), artifact.filename())
+                    if path.exists(source):
+                        checksum = dw.checksums.digest(source, 'sha1')
+                        return source, dict(name=str(artifact), checksum=checksum, **artifact.__dict__)
+
+                dw.resolve_version(artifact)
+                directory = path.join(cache_dir, 'files', artifact.path())
+                if not path.isdir(directory):
+                    os.makedirs(directory)
+
+                result = dw.download(artifact, directory, False)
+                result['checksum'] = dw.checksums.digest(result['path'], 'sha1')
+                return result['path'], result
+            finally:
+                dw.close()
+        finally:
+            lock.close()
+
+    def _checksum(self, mvn_get, artifact, params, cache_dir):
+        ''' Resolves SHA-1 checksum of the artifact without downloading it
+        (for check mode), from the cache on the controller or from the
+        checksum file in the repository. Nothing is written into the cache.
+
+        :returns: the result with checksum, which is None if the repository
+            doesn't provide it
+        '''
+        dw = mvn_get.make_downloader(params, cache_dir, check_mode=True)
+        try:
+            dw.resolve_version(artifact)
+            source = path.join(cache_dir, 'files', artifact.path(), artifact.filename())
+            if not artifact.is_snapshot() and path.exists(source):
+                checksum = dw.checksums.digest(source, 'sha1')
+            else:
+                checksum = dw.remote_checksum(artifact, 'sha1')
+            return dict(name=str(artifact), checksum=checksum, **artifact.__dict__)
+        finally:
+            dw.close()
+
+    def _push(self, conn, tmp, source, filename, params, cache_dir, result, inject):
+        ''' Copies the file to the host if its checksum differs. The source
+        is None in check mode. '''
+
+        dest = params['dest']
+        remote_checksum = self.runner._remote_checksum(conn, tmp, dest, inject)
+        if remote_checksum == '3':  # dest is a directory
+            dest = path.join(dest, filename)
+            remote_checksum = self.runner._remote_checksum(conn, tmp, dest, inject)
+
+        file_args = dict((k, params[k]) for k in FILE_OPTIONS if params.get(k) is not None)
+        result = dict(result, dest=dest, path=dest)
+        result.pop('changed', None)
+
+        if remote_checksum == result['checksum']:
+            if not file_args:
+                return ReturnData(conn=conn, result=dict(result, changed=False))
+            # only the attributes might differ
+            file_module_args = ''
+            if self.runner.noop_on_check(inject):
+                file_module_args = "CHECKMODE=True"
+            return self.runner._execute_module(
+                conn, tmp, 'file', file_module_args, inject=inject,
+                complex_args=dict(file_args, path=dest))
+
+        if self.runner.noop_on_check(inject):
+            return ReturnData(conn=conn, result=dict(result, changed=True))
+
+        slot = self._acquire_slot(path.join(cache_dir, 'transfers'), params['max_transfers'])
+        try:
+            tmp_src = tmp + path.basename(source)
+            conn.put_file(source, tmp_src)
+        finally:
+            slot.close()
+
+        # the file must be readable by the sudo user
+        self.runner._remote_chmod(conn, 'a+r', tmp_src, tmp)
+
+        copy_args = dict(file_args, src=tmp_src, dest=dest, original_basename=path.basename(source))
+        copied = self.runner._execute_module(conn, tmp, 'copy', '', inject=inject,
+                                             complex_args=copy_args)
+        copied.result = dict(result, **copied.result)
+        return copied
+
+    def _acquire_slot(self, directory, count):
+        ''' Waits until one of the count slots is free and locks it.
+
+        :returns: locked file, it's released by closing it
+        '''
+        while True:
+            for i in range(max(count, 1)):
+                try:
+                    return self._flock(path.join(directory, str(i)), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    pass  # occupied
+            time.sleep(0.1)
+
+    def _flock(self, filename, operation):
+        ''' Opens the lock file and locks it. '''
+
+        if not path.isdir(path.dirname(filename)):
+            try:
+                os.makedirs(path.dirname(filename))
+            except OSError:
+                pass  # created by another fork meanwhile
+        f = open(filename, 'a')
+        try:
+            fcntl.flock(f, operation)
+        except:
+            f.close()
+            raise
+        return f
+
+    def _load_module(self):
+        ''' Load code of the mvn_get module. '''
+
+        return imp.load_source('ansible_module_mvn_get', plugins.module_finder.find_plugin('mvn_get'))
+
+    def _module_params(self, mvn_get, options):
+        ''' Resolve aliases, defaults and types of the module options. '''
+
+        params = dict(options)
+        for name, spec in mvn_get.ARGUMENT_SPEC.items():
+            for alias in spec.get('aliases', []):
+                if alias in params:
+                    params[name] = params.pop(alias)
+            value = params.get(name, spec.get('default'))
+
+            if isinstance(value, basestring):
+                if spec.get('type') == 'bool':
+                    value = utils.boolean(value)
+                elif spec.get('type') == 'int':
+                    value = int(value)
+                elif spec.get('type') == 'list':
+                    value = value.split(',')
+            params[name] = value
+
+        return params
+
+    def _load_options(self, module_args, complex_args):
+        ''' Load module options. '''
+
+        options = {}
+        if complex_args:
+            options.update(complex_args)
+        options.update(utils.parse_kv(module_args))
+
+        return options
+
+    def _fail(self, conn, msg):
+        return ReturnData(conn=conn, result=dict(failed=True, msg=msg))
+
+
+def hash_name(name):
+    return hashlib.sha1(name).hexdigest()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# (c) 2015, Jakub Jirutka <jakub@jirutka.cz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Benchmark of the mvn_get module against a local Maven repository.
+
+It generates a repository with the Maven layout (release and SNAPSHOT
+metadata, checksums, large synthetic artifacts) in a temporary directory,
+serves it over HTTP on localhost with optional latency and bandwidth limit,
+and runs the scenarios with MavenDownloader, each in a separate process.
+For each scenario it reports wall time, peak RSS of the process, and number
+of HTTP requests and bytes served by the repository.
+
+Usage: python2 benchmarks/mvn_get_bench.py [options] [scenario...]
+'''
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import imp
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+from os import path
+from urllib2 import urlopen
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+MODULE_PATH = path.join(path.dirname(path.abspath(__file__)),
+                        '..', 'library', 'packaging', 'mvn_get.py')
+
+GROUP_ID = 'org.example.bench'
+
+# Versions of the large artifact; listed in the metadata in this (wrong) order.
+RELEASES = ['1.0', '1.10', '1.2', '1.9']
+SNAPSHOT = '2.0-SNAPSHOT'
+SNAPSHOT_TIMESTAMP = '20150101.120000'
+
+SCENARIOS = {
+    'single': 'download the latest release of a large artifact',
+    'batch': 'download many small artifacts concurrently',
+    'cached': 'download a large artifact again, it is unchanged',
+    'check_mode': 'decide whether a large artifact would be downloaded',
+    'snapshot': 'download a SNAPSHOT of a large artifact',
+    'segmented': 'download a large artifact in 4 concurrent segments',
+}
+
+BLOCK_SIZE = 64 * 1024
+
+
+##### Repository #####
+
+def create_repository(root, artifact_size, batch_size, small_size):
+    '''Generates a Maven repository in the directory root.'''
+
+    release = RELEASES[:]
+    release.sort(key=lambda v: [int(x) for x in v.split('.')])
+    write_metadata(root, 'big', RELEASES)
+    write_artifact(root, 'big', release[-1], 'big-%s.jar' % release[-1], artifact_size)
+
+    snapshot_file = 'big-%s-%s-1.jar' % (SNAPSHOT[:-len('-SNAPSHOT')], SNAPSHOT_TIMESTAMP)
+    write_snapshot_metadata(root, 'big', SNAPSHOT)
+    write_artifact(root, 'big', SNAPSHOT, snapshot_file, artifact_size)
+
+    for i in range(batch_size):
+        name = 'lib%d' % i
+        write_metadata(root, name, ['1.0'])
+        write_artifact(root, name, '1.0', '%s-1.0.jar' % name, small_size)
+
+
+def write_artifact(root, artifact_id, version, filename, size):
+    directory = path.join(root, GROUP_ID.replace('.', '/'), artifact_id, version)
+    if not path.isdir(directory):
+        os.makedirs(directory)
+    filepath = path.join(directory, filename)
+
+    block = os.urandom(BLOCK_SIZE)
+    digests = [hashlib.sha1(), hashlib.md5()]
+    f = open(filepath, 'wb')
+    try:
+        written = 0
+        while written < size:
+            chunk = block[:min(BLOCK_SIZE, size - written)]
+            f.write(chunk)
+            for d in digests:
+                d.update(chunk)
+            written += len(chunk)
+    finally:
+        f.close()
+
+    for ext, digest in zip(('sha1', 'md5'), digests):
+        write_file(filepath + '.' + ext, digest.hexdigest())
+
+
+def write_metadata(root, artifact_id, versions):
+    versions_xml = ''.join('<version>%s</version>' % v for v in versions)
+    write_file(path.join(root, GROUP_ID.replace('.', '/'), artifact_id, 'maven-metadata.xml'),
+               '<metadata><groupId>%s</groupId><artifactId>%s</artifactId>'
+               '<versioning><versions>%s</versions></versioning></metadata>'
+               % (GROUP_ID, artifact_id, versions_xml))
+
+
+def write_snapshot_metadata(root, artifact_id, version):
+    value = '%s-%s-1' % (version[:-len('-SNAPSHOT')], SNAPSHOT_TIMESTAMP)
+    write_file(path.join(root, GROUP_ID.replace('.', '/'), artifact_id, version, 'maven-metadata.xml'),
+               '<metadata><groupId>%s</groupId><artifactId>%s</artifactId><version>%s</version>'
+               '<versioning><snapshotVersions><snapshotVersion><extension>jar</extension>'
+               '<value>%s</value></snapshotVersion></snapshotVersions></versioning></metadata>'
+               % (GROUP_ID, artifact_id, version, value))
+
+
+def write_file(filepath, content):
+    if not path.isdir(path.dirname(filepath)):
+        os.makedirs(path.dirname(filepath))
+    f = open(filepath, 'w')
+    try:
+        f.write(content)
+    finally:
+        f.close()
+
+
+##### HTTP server #####
+
+class RepositoryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server of the repository in directory root. Each response is
+    delayed by latency seconds and bodies are sent at most at bandwidth bytes
+    per second per connection (0 is unlimited). It counts the requests and
+    bytes sent, they are available at /__stats__.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, latency=0, bandwidth=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RepositoryHandler)
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, requests, size):
+        self.lock.acquire()
+        try:
+            self.requests += requests
+            self.bytes += size
+        finally:
+            self.lock.release()
+
+
+class RepositoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self, with_body):
+        server = self.server
+        if self.path == '/__stats__':
+            body = json.dumps({'requests': server.requests, 'bytes': server.bytes})
+            return self._respond(200, {'Content-Type': 'application/json'}, body)
+
+        server.count(1, 0)
+        if server.latency:
+            time.sleep(server.latency)
+
+        filepath = path.join(server.root, self.path.split('?')[0].lstrip('/'))
+        if not path.isfile(filepath):
+            return self._respond(404, {}, '')
+
+        st = os.stat(filepath)
+        etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        headers = {'ETag': etag, 'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+                   'Accept-Ranges': 'bytes'}
+        if self.headers.get('If-None-Match') == etag:
+            return self._respond(304, headers, None)
+
+        start, end, status = 0, st.st_size - 1, 200
+        ranges = self.headers.get('Range', '')
+        if ranges.startswith('bytes=') and self.headers.get('If-Range', etag) == etag:
+            first, last = ranges[len('bytes='):].split('-')
+            start, end, status = int(first), last and int(last) or end, 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, st.st_size)
+
+        length = end - start + 1
+        headers['Content-Length'] = str(length)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if with_body:
+            f = open(filepath, 'rb')
+            try:
+                f.seek(start)
+                self._send_body(f, length)
+            finally:
+                f.close()
+
+    def _send_body(self, f, length):
+        bandwidth = self.server.bandwidth
+        started = time.time()
+        sent = 0
+        while sent < length:
+            chunk = f.read(min(BLOCK_SIZE, length - sent))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self.server.count(0, len(chunk))
+            if bandwidth:
+                ahead = float(sent) / bandwidth - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def _respond(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+##### Scenarios #####
+
+def load_module():
+    '''Loads the mvn_get module without the Ansible boilerplate at its end,
+    so the benchmark doesn't need Ansible installed.
+    '''
+    f = open(MODULE_PATH)
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    module = imp.new_module('mvn_get')
+    module.__file__ = MODULE_PATH
+    source = source[:source.index('# import module snippets')]
+    exec compile(source, MODULE_PATH, 'exec') in module.__dict__
+    return module
+
+
+def run_scenario(name, url, workdir, opts):
+    '''Runs the scenario and returns its measurements. It's supposed to run
+    in a fresh process, so the peak RSS is of this scenario only.
+    '''
+    mvn_get = load_module()
+    dest = tempfile.mkdtemp(dir=workdir)
+    cache_dir = path.join(dest, '.cache')
+
+    def downloader(**kwargs):
+        return mvn_get.MavenDownloader(
+            url, metadata_cache=mvn_get.MetadataCache(path.join(cache_dir, 'metadata')),
+            checksum_index=mvn_get.ChecksumIndex(path.join(cache_dir, 'checksums.json')),
+            **kwargs)
+
+    def artifact(artifact_id, version=None):
+        return mvn_get.Artifact(GROUP_ID, artifact_id, version, None, 'jar')
+
+    if name == 'cached':
+        dw = downloader()
+        dw.download(artifact('big'), dest, False)
+        dw.close()
+
+    dw = downloader(segments=name == 'segmented' and 4 or 1)
+    before = server_stats(url)
+    started = time.time()
+
+    if name in ('single', 'cached', 'segmented'):
+        results = [dw.download(artifact('big'), dest, False)]
+    elif name == 'check_mode':
+        results = [dw.download(artifact('big'), dest, True)]
+    elif name == 'snapshot':
+        results = [dw.download(artifact('big', SNAPSHOT), dest, False)]
+    elif name == 'batch':
+        items = [(artifact('lib%d' % i, '1.0'), dest) for i in range(opts.batch)]
+        results = dw.download_all(items, False, opts.workers)
+
+    elapsed = time.time() - started
+    dw.close()
+    after = server_stats(url)
+
+    failed = [r['msg'] for r in results if r.get('failed')]
+    return {
+        'scenario': name,
+        'wall_time': elapsed,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'requests': after['requests'] - before['requests'],
+        'bytes': after['bytes'] - before['bytes'],
+        'changed': len([r for r in results if r.get('changed')]),
+        'failed': failed,
+    }
+
+
+def server_stats(url):
+    response = urlopen(url + '/__stats__')
+    try:
+        return json.load(response)
+    finally:
+        response.close()
+
+
+##### Main #####
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [scenario...]',
+                                   description='Scenarios: ' + ', '.join(sorted(SCENARIOS)))
+    parser.add_option('--size', type='int', default=64,
+                      help='size of the large artifact in MiB [%default]')
+    parser.add_option('--batch', type='int', default=50,
+                      help='number of artifacts in the batch scenario [%default]')
+    parser.add_option('--small-size', type='int', default=256,
+                      help='size of the artifacts in the batch scenario in KiB [%default]')
+    parser.add_option('--workers', type='int', default=4,
+                      help='concurrent downloads in the batch scenario [%default]')
+    parser.add_option('--latency', type='float', default=0,
+                      help='delay of each response in milliseconds [%default]')
+    parser.add_option('--bandwidth', type='float', default=0,
+                      help='bandwidth limit per connection in MiB/s, 0 is unlimited [%default]')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='number of runs of each scenario, the fastest is reported [%default]')
+    parser.add_option('--json', action='store_true',
+                      help='print the results as JSON')
+    # internal, used to run the scenario in a subprocess
+    parser.add_option('--run', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--url', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--workdir', help=optparse.SUPPRESS_HELP)
+
+    opts, scenarios = parser.parse_args(argv)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: %s" % name)
+    return opts, scenarios or sorted(SCENARIOS)
+
+
+def spawn_scenario(name, url, workdir, argv):
+    proc = subprocess.Popen([sys.executable, path.abspath(__file__), '--run', name,
+                             '--url', url, '--workdir', workdir] + argv,
+                            stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise SystemExit("Scenario %s failed" % name)
+    return json.loads(output)
+
+
+def print_table(results):
+    row = '%-12s %10s %14s %9s %14s %10s'
+    print row % ('scenario', 'wall [s]', 'peak RSS [MiB]', 'requests', 'bytes', 'MiB/s')
+    for r in results:
+        rate = r['wall_time'] and r['bytes'] / r['wall_time'] / 1024 / 1024 or 0
+        print row % (r['scenario'], '%.3f' % r['wall_time'], '%.1f' % (r['peak_rss'] / 1024.0 / 1024),
+                     r['requests'], r['bytes'], '%.1f' % rate)
+        for msg in r['failed']:
+            print '  failed: %s' % msg
+
+
+def main(argv):
+    opts, scenarios = parse_args(argv)
+
+    if opts.run:
+        print json.dumps(run_scenario(opts.run, opts.url, opts.workdir, opts))
+        return
+
+    workdir = tempfile.mkdtemp(prefix='mvn_get_bench')
+    try:
+        root = path.join(workdir, 'repository')
+        create_repository(root, opts.size * 1024 * 1024, opts.batch, opts.small_size * 1024)
+
+        server = RepositoryServer(root, opts.latency / 1000.0, int(opts.bandwidth * 1024 * 1024))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+        # options of the scenarios passed to the subprocesses
+        child_argv = ['--batch', str(opts.batch), '--workers', str(opts.workers)]
+        results = []
+        for name in scenarios:
+            runs = [spawn_scenario(name, server.url(), workdir, child_argv)
+                    for _ in range(max(opts.repeat, 1))]
+            results.append(min(runs, key=lambda r: r['wall_time']))
+        server.shutdown()
+
+        if opts.json:
+            print json.dumps(results, indent=2)
+        else:
+            print_table(results)
+    finally:
+        shutil.rmtree(workdir, True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -35,15 +35,52 @@ options:
     description:
       - Password for a simple authentication.
     required: true
+  batch_size:
+    description:
+      - Number of entries from the LDIF that are processed at once; the LDIF is read as a stream,
+        so it limits the memory used for big files. An entry may precede its parent in the LDIF
+        only within the same batch.
+      - When removing subtrees (see C(subtree)), it's the page size of the search.
+    required: false
+    default: 1000
+  cache_dir:
+    description:
+      - Directory on the remote host for caching the schema of the LDAP server between runs (see
+        C(normalize_values)). Set to an empty string to disable the cache.
+    required: false
+    default: ~/.cache/ansible-ldap
   content:
     description:
       - When used instead of C(src), sets the LDIF directly to the specified value.
+      - Besides entries, the LDIF may contain change records (C(changetype) add, delete, modify
+        and modrdn). They are executed as they are, without reading the entries first. When
+        a change record fails just because the change is already done (e.g. the added value
+        exists), it's reduced to the missing changes, so applying it again doesn't fail.
+    required: false
+  journal:
+    description:
+      - Path of a file on the remote machine where a fingerprint of each entry from the LDIF is
+        recorded along with the server's C(entryCSN) or C(modifyTimestamp) of the entry. On the
+        next run, entries whose fingerprint and server stamp are both unchanged are skipped
+        without reading and comparing them, so it needs just a search of the stamps.
+      - The server must provide C(entryCSN) (OpenLDAP) or C(modifyTimestamp) of the entries,
+        others are always compared.
     required: false
   ldap_uri:
     description:
       - URI of the LDAP server to connect to.
     required: false
     default: ldap://localhost:389
+  normalize_values:
+    description:
+      - Whether to compare values of the attributes according to their equality matching rule
+        from the server's schema, e.g. C(mail) case-insensitively or DNs regardless of spacing.
+        Values that differ just in such way from the existing ones are not written. The schema
+        is read from the server's subschema subentry and cached in C(cache_dir) until it's
+        modified.
+    required: false
+    default: yes
+    choices: [yes, no]
   remove_unset_attrs:
     description:
       - When an existing entry contains attributes that are not specified in the updated entry and
@@ -57,7 +94,16 @@ options:
         C(.j2), then it is considered as a Jinja2 formatted template.
       - When C(state=absent), then the file may contain just distinguished names (DN) separated by
         a new line.
+      - When C(remote_src=yes), then it means path on the remote machine instead (templating is
+        not supported in this mode).
+    required: false
+  remote_src:
+    description:
+      - If C(no), the LDIF file will be copied from the local machine, otherwise it will be read
+        on the remote machine. Use it for big files, they are not loaded into memory at once.
     required: false
+    default: no
+    choices: [yes, no]
   state:
     description:
       - Whether the entries should exist, i.e. adds new and updates existing. When C(absent),
@@ -65,12 +111,36 @@ options:
     required: false
     default: present
     choices: [present, absent]
+  subtree:
+    description:
+      - When C(state=absent) and this is set to C(yes), then the entries are removed including
+        all their descendants. The Tree Delete control is used when the server supports it,
+        otherwise the subtree is searched page by page (C(batch_size) entries per page) and
+        deleted from leaves up using C(workers) connections.
+    required: false
+    default: no
+    choices: [yes, no]
   timeout:
     description:
       - A limit on the number of seconds that the action will wait for a response from
         the LDAP server.
     required: false
     default: 10
+  max_pending:
+    description:
+      - Maximal number of write operations sent to the LDAP server without waiting for their
+        results. Values greater than 1 make writes much faster on links with high latency;
+        an entry is still written only after its parent entry, resp. deleted only after its
+        child entries.
+    required: false
+    default: 1
+  workers:
+    description:
+      - Number of connections to the LDAP server used to write entries in parallel. An entry is
+        written only after its parent entry in the LDIF exists, so independent subtrees are
+        written at once and the entries in the LDIF don't have to be sorted.
+    required: false
+    default: 1
 '''
 
 EXAMPLES = '''
@@ -81,6 +151,21 @@ EXAMPLES = '''
   bind_password=top-secret
   src=base.ldif
 
+# Ensure entries over a slow link, up to 50 write operations at once
+- ldap: >
+  ldap_uri=ldaps://grid.encom.com
+  bind_dn='cn=master,dc=encom,dc=com'
+  bind_password=top-secret
+  src=users.ldif
+  max_pending=50
+
+# Ensure entries of several tenants using 4 connections
+- ldap: >
+  bind_dn='cn=master,dc=encom,dc=com'
+  bind_password=top-secret
+  src=tenants.ldif
+  workers=4
+
 # Ensure entry in LDAP from LDIF content
 - ldap: >
   bind_dn='cn=master,dc=encom,dc=com'
@@ -89,6 +174,32 @@ EXAMPLES = '''
     objectClass: top
     objectClass: domain'
 
+# Add members to groups without reading the groups
+- ldap: >
+  bind_dn='cn=master,dc=encom,dc=com'
+  bind_password=top-secret
+  max_pending=50
+  content='dn: cn=users,ou=Groups,dc=encom,dc=com
+    changetype: modify
+    add: member
+    member: uid=clu,ou=People,dc=encom,dc=com
+    member: uid=tron,ou=People,dc=encom,dc=com
+    -'
+
+# Ensure entries from a big LDIF file located on the remote system
+- ldap: >
+  bind_dn='cn=master,dc=encom,dc=com'
+  bind_password=top-secret
+  remote_src=yes
+  src=/var/backups/encom.ldif
+
+# Ensure entries, skip the ones unchanged since the last run
+- ldap: >
+  bind_dn='cn=master,dc=encom,dc=com'
+  bind_password=top-secret
+  src=users.ldif
+  journal=/var/lib/ldap/users.journal
+
 # Remove entries from LDAP
 - ldap: >
   bind_dn='cn=master,dc=encom,dc=com'
@@ -96,18 +207,54 @@ EXAMPLES = '''
   state=absent
   content='cn=clue,ou=People,dc=encom,dc=com
            cn=jarvis,ou=People,dc=encom,dc=com'
+
+# Remove a tenant with all its entries
+- ldap: >
+  bind_dn='cn=master,dc=encom,dc=com'
+  bind_password=top-secret
+  state=absent
+  subtree=yes
+  workers=4
+  content='o=flynn,dc=encom,dc=com'
 '''
 
+import base64
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from collections import deque
+from Queue import Queue, Empty
+from os import path
 from StringIO import StringIO
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 try:
     import ldap
+    import ldap.dn
+    import ldap.filter
+    import ldap.schema
+    from ldap.controls import LDAPControl, SimplePagedResultsControl
     from ldap.modlist import addModlist, modifyModlist
-    from ldif import LDIFRecordList
+    from ldif import is_dn
     HAS_PYTHON_LDAP = True
 except ImportError:
     HAS_PYTHON_LDAP = False
 
+# Maximal number of RDNs in the OR filter of a single prefetch search.
+PREFETCH_BATCH_SIZE = 100
+
+# OID of the Tree Delete control (deletes an entry with all its descendants).
+TREE_DELETE_OID = '1.2.840.113556.1.4.805'
+
+# Operational attributes that change with each modification of an entry.
+STAMP_ATTRS = ['entryCSN', 'modifyTimestamp']
+
 
 class LDAPModule(object):
 
@@ -117,7 +264,21 @@ class LDAPModule(object):
         :param dryrun: if True then no write operation will be made in LDAP
         '''
         self.remove_unset_attrs = params['remove_unset_attrs']
+        self.max_pending = max(int(params['max_pending']), 1)
+        self.workers = max(int(params['workers']), 1)
+        self.batch_size = max(int(params['batch_size']), 1)
         self.dryrun = dryrun
+        self._params = params
+        self._entries = {}
+        self._dryrun_entries = {}
+        self._pending = deque()
+        self._pending_dns = {}
+        self._pending_ancestors = {}
+        self._pool = None
+        self.matching_rules = None
+        self.journal = None
+        if params.get('journal'):
+            self.journal = Journal(path.expanduser(params['journal']), params['ldap_uri'])
 
         self._conn = ldap.initialize(params['ldap_uri'])
         self._conn.protocol_version = ldap.VERSION3
@@ -126,80 +287,1286 @@ class LDAPModule(object):
         self._conn.simple_bind_s(params['bind_dn'], params['bind_password'])
 
     def close(self):
-        '''Closes the LDAP connection.
+        '''Closes the LDAP connection (and connections of the workers).
         '''
+        for worker in (self._pool or [])[1:]:
+            worker.close()
         self._conn.unbind_s()
 
-    def delete(self, dn):
-        try:
-            if not self.dryrun:
-                self._conn.delete_s(dn)
-            changed = True
-        except ldap.NO_SUCH_OBJECT:
-            changed = False
+    def delete(self, dn, callback=None):
+        '''Sends request to delete the entry with the given DN, missing
+        entry is ignored. The result is collected later, see flush().
+
+        :param dn: DN of the entry to delete
+        :param callback: function to call with the DN when the entry is
+            actually deleted
+        '''
+        if self.dryrun:
+            self._dryrun_entries[normalize_dn(dn)] = None
+            if callback: callback(dn)
+        else:
+            self._send(dn, self._conn.delete_ext, (dn,), ldap.NO_SUCH_OBJECT, callback)
+
+    def change(self, dn, record, callback=None):
+        '''Sends the LDIF change record. An add of an existing entry is turned
+        into update of the entry, a modify that fails because a value already
+        exists or doesn't exist is reduced to the actual changes, and delete
+        or modrdn of a missing entry (already renamed) is ignored.
+
+        :param dn: DN of the entry to change
+        :param record: the ChangeRecord
+        :param callback: function to call with the DN when the entry is
+            actually changed
+        '''
+        if record.changetype == 'add':
+            modlist = addModlist(record.attrs)
+            operation, args = self._conn.add_ext, (dn, modlist)
+            ignore = ldap.ALREADY_EXISTS
+            errback = lambda dn, e: self._update_existing(dn, record.attrs)
+        elif record.changetype == 'delete':
+            operation, args = self._conn.delete_ext, (dn,)
+            ignore, errback = ldap.NO_SUCH_OBJECT, None
+        elif record.changetype == 'modify':
+            operation, args = self._conn.modify_ext, (dn, record.modlist)
+            ignore = (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE)
+            errback = lambda dn, e: self._modify_effective(dn, record.modlist)
+        else:  # modrdn
+            operation = self._conn.rename
+            args = (dn, record.newrdn, record.newsuperior, int(record.deleteoldrdn))
+            ignore, errback = ldap.NO_SUCH_OBJECT, self._check_renamed(record)
+
+        if self.dryrun:
+            self._dryrun_change(dn, record, callback)
+        elif record.changetype == 'modrdn':
+            # the entry is known under two DNs, so nothing may be pending around it
+            self.flush()
+            self._send(dn, operation, args, ignore, callback, errback)
+            self.flush()
+        else:
+            self._send(dn, operation, args, ignore, callback, errback)
+
+    def delete_subtree(self, dn):
+        '''Deletes the entry with the given DN including all its descendants,
+        ignores missing. It uses the Tree Delete control if the server supports
+        it. Otherwise it searches the subtree using paged results and deletes
+        the entries of each page from the deepest ones in parallel; entries
+        with children on other pages are deleted in the next pass.
+
+        :param dn: DN of the subtree's root entry
+        :returns: True if any entry was actually deleted, False otherwise
+        '''
+        if self.dryrun:
+            exists = self._dryrun_entry(dn, ['1.1']) is not None
+            self._dryrun_entries[normalize_dn(dn)] = None
+            return exists
+
+        if self.supports_control(TREE_DELETE_OID):
+            deleted = []
+            self._send(dn, self._conn.delete_ext, (dn, [LDAPControl(TREE_DELETE_OID, True)]),
+                       ldap.NO_SUCH_OBJECT, deleted.append)
+            self.flush()
+            return bool(deleted)
+
+        deleted = []
+        delete_leaves = lambda ldapm, dn_list: ldapm._delete_leaves(dn_list, deleted.append)
+        total = 0
+        while True:
+            found = False
+            for page in self._paged_search(dn):
+                found = True
+                levels = {}
+                for entry_dn in page:
+                    levels.setdefault(len(ldap.dn.str2dn(entry_dn)), []).append(entry_dn)
+                for depth in sorted(levels, reverse=True):
+                    self._in_parallel(delete_leaves, levels[depth])
+            if not found:
+                return total > 0
+            if not deleted:
+                raise ldap.NOT_ALLOWED_ON_NONLEAF(
+                    {'desc': 'Subtree could not be deleted', 'dn': dn})
+            total += len(deleted)
+            del deleted[:]
+
+    def delete_subtrees(self, dn_list):
+        '''Deletes all subtrees with the given root DN, ignores missing.
+
+        :param dn_list: list of DNs to delete
+        :returns: True if any entry was actually deleted, False otherwise
+        '''
+        changed = False
+        for dn in dn_list:
+            if self.delete_subtree(dn): changed = True
 
         return changed
 
+    def supports_control(self, oid):
+        '''
+        :returns: True if the server advertises the control in root DSE
+        '''
+        try:
+            root_dse = self._conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                                           ['supportedControl'])
+        except ldap.LDAPError:
+            return False
+        return bool(root_dse) and oid in root_dse[0][1].get('supportedControl', [])
+
+    def _delete_leaves(self, dn_list, callback):
+        '''Deletes the entries, ignores missing and the ones with children.
+        '''
+        for dn in dn_list:
+            self._send(dn, self._conn.delete_ext, (dn,),
+                       (ldap.NO_SUCH_OBJECT, ldap.NOT_ALLOWED_ON_NONLEAF), callback)
+        self.flush()
+
+    def _paged_search(self, base):
+        '''Searches DNs of all the entries in the subtree using the Simple
+        Paged Results control.
+
+        :param base: DN of the subtree's root entry
+        :returns: generator of lists of DNs, one for each page
+        '''
+        control = SimplePagedResultsControl(True, size=self.batch_size, cookie='')
+        while True:
+            try:
+                msgid = self._conn.search_ext(base, ldap.SCOPE_SUBTREE, '(objectClass=*)',
+                                              ['1.1'], serverctrls=[control])
+                rtype, rdata, rmsgid, rctrls = self._conn.result3(msgid, all=1,
+                                                                  timeout=self._conn.timeout)
+            except ldap.NO_SUCH_OBJECT:
+                return
+            page = [dn for dn, attrs in rdata if dn is not None]
+            if page:
+                yield page
+
+            cookies = [c.cookie for c in rctrls
+                       if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                return
+            control.cookie = cookies[0]
+
+    def _worker_pool(self):
+        '''
+        :returns: list of LDAPModule instances with their own connection,
+            this one is the first; they share the prefetched entries
+        '''
+        if self._pool is None:
+            self._pool = [self]
+            for _ in range(self.workers - 1):
+                worker = LDAPModule(dict(self._params, journal=None), self.dryrun)
+                worker._entries = self._entries  # prefetched by this one
+                worker._dryrun_entries = self._dryrun_entries
+                worker.matching_rules = self.matching_rules
+                self._pool.append(worker)
+        return self._pool
+
+    def _in_parallel(self, function, items):
+        '''Splits the items among the worker pool and calls the function with
+        the worker and its part of items, each in its own thread.
+        '''
+        pool = self._worker_pool()[:len(items)]
+        if len(pool) == 1:
+            return function(self, items)
+
+        errors = []
+
+        def work(ldapm, part):
+            try:
+                function(ldapm, part)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work, args=(ldapm, items[i::len(pool)]))
+                   for i, ldapm in enumerate(pool)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
     def delete_all(self, dn_list):
         '''Deletes all entries with the given DN, ignores missing.
 
         :param dn_list: list of DNs to delete
         :returns: True if any entry was actually deleted, False otherwise
         '''
-        changed = False
+        deleted = []
         for dn in dn_list:
-            if self.delete(dn): changed = True
+            self.delete(dn, deleted.append)
+        self.flush()
 
-        return changed
+        return bool(deleted)
 
-    def insert(self, dn, attrs):
+    def insert(self, dn, attrs, callback=None):
         modlist = addModlist(attrs)
         if not self.dryrun:
-            self._conn.add_s(dn, modlist)
+            self._send(dn, self._conn.add_ext, (dn, modlist), callback=callback)
+        elif callback:
+            callback(dn)
 
         return True
 
-    def update(self, dn, old_attrs, new_attrs):
+    def update(self, dn, old_attrs, new_attrs, callback=None):
+        if self.matching_rules:
+            new_attrs = canonicalize(self.matching_rules, old_attrs, new_attrs)
         modlist = modifyModlist(old_attrs, new_attrs,
                                 ignore_oldexistent=not(self.remove_unset_attrs))
+        if modlist and not self.dryrun:
+            self._send(dn, self._conn.modify_ext, (dn, modlist), callback=callback)
+        elif callback:
+            callback(dn)
+
+        return bool(modlist)
+
+    def _update_existing(self, dn, attrs):
+        '''Updates the entry that already exists instead of adding it.
+
+        :returns: True if the entry was changed, False otherwise
+        '''
+        old_attrs = self._conn.search_s(dn, ldap.SCOPE_BASE)[0][1]
+        if self.matching_rules:
+            attrs = canonicalize(self.matching_rules, old_attrs, attrs)
+        modlist = modifyModlist(old_attrs, attrs, ignore_oldexistent=not(self.remove_unset_attrs))
         if modlist and not self.dryrun:
             self._conn.modify_s(dn, modlist)
 
         return bool(modlist)
 
-    def upsert(self, dn, attrs):
-        try:
-            old_entry = self._conn.search_s(dn, ldap.SCOPE_BASE)
-            changed = self.update(dn, old_entry[0][1], attrs)
-        except ldap.NO_SUCH_OBJECT:
-            changed = self.insert(dn, attrs)
+    def _modify_effective(self, dn, modlist):
+        '''Reads the attributes of the entry the modlist touches and modifies
+        it with just the operations that actually change it.
+
+        :returns: True if the entry was changed, False otherwise
+        '''
+        names = list(set(attr for op, attr, values in modlist))
+        old_attrs = self._conn.search_s(dn, ldap.SCOPE_BASE, attrlist=names)[0][1]
+        modlist = effective_modlist(self.matching_rules or {}, old_attrs, modlist)
+        if modlist and not self.dryrun:
+            self._conn.modify_s(dn, modlist)
+
+        return bool(modlist)
+
+    def _check_renamed(self, record):
+        '''
+        :returns: function that checks if the missing entry to rename has
+            already been renamed, i.e. the new DN exists
+        '''
+        def check(dn, error):
+            new_dn = renamed_dn(dn, record)
+            if self.search_entries([new_dn], ['1.1']).get(normalize_dn(new_dn)) is None:
+                raise error
+            return False
+        return check
+
+    def _dryrun_change(self, dn, record, callback):
+        '''Finds out whether the change record would change the entry, as it
+        would be after the preceding records of the dry run.
+        '''
+        key = normalize_dn(dn)
+        if record.changetype == 'add':
+            self._entries[key] = self._dryrun_entry(dn)
+            changed = self.upsert(dn, record.attrs)
+        elif record.changetype == 'modify':
+            names = list(set(attr for op, attr, values in record.modlist))
+            old_attrs = self._dryrun_entry(dn, names)
+            if old_attrs is None:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'dn': dn})
+            new_attrs = {}
+            changed = bool(effective_modlist(self.matching_rules or {}, old_attrs,
+                                             record.modlist, new_attrs))
+            self._dryrun_write(dn, new_attrs)
+        elif record.changetype == 'delete':
+            changed = self._dryrun_entry(dn, ['1.1']) is not None
+            self._dryrun_entries[key] = None
+        else:  # modrdn
+            old_attrs = self._dryrun_entry(dn)
+            new_dn = renamed_dn(dn, record)
+            if old_attrs is not None:
+                changed = True
+                self._dryrun_entries[key] = None
+                self._dryrun_write(new_dn, old_attrs, True)
+            elif self._dryrun_entry(new_dn, ['1.1']) is not None:
+                changed = False  # already renamed
+            else:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'dn': dn})
+        if changed and callback:
+            callback(dn)
+
+    def _dryrun_entry(self, dn, attrlist=None):
+        '''
+        :param attrlist: list of attributes to fetch from the server, or None
+            for all
+        :returns: hash of attributes of the entry as it would be after the
+            preceding writes of the dry run, or None if it wouldn't exist
+        '''
+        key = normalize_dn(dn)
+        written = self._dryrun_entries.get(key, False)
+        attrs = None
+        if written is False or (written and not written[1]):
+            attrs = self.search_entries([dn], attrlist).get(key)
+        return self._dryrun_state(key, attrs)
+
+    def _dryrun_state(self, key, attrs):
+        '''
+        :param key: normalized DN of the entry
+        :param attrs: hash of attributes of the entry on the server, or None
+            if it doesn't exist
+        :returns: hash of attributes of the entry as it would be after the
+            preceding writes of the dry run, or None if it wouldn't exist
+        '''
+        if key not in self._dryrun_entries:
+            return attrs
+        if self._dryrun_entries[key] is None:
+            return None
+        written, complete = self._dryrun_entries[key]
+        if not complete:
+            written = merge_attrs(attrs or {}, written)
+        return dict((name, values) for name, values in written.items() if values)
+
+    def _dryrun_write(self, dn, attrs, complete=False):
+        '''Remembers the attributes that would be written into the entry in
+        the dry run, so the following records see them.
+
+        :param attrs: hash of attributes; an attribute with no values is
+            removed
+        :param complete: whether the attrs are all the attributes of the
+            entry, otherwise they replace the ones on the server
+        '''
+        key = normalize_dn(dn)
+        written = self._dryrun_entries.get(key)
+        if written and not complete:
+            attrs, complete = merge_attrs(written[0], attrs), written[1]
+        self._dryrun_entries[key] = (attrs, complete)
+
+    def flush(self):
+        '''Waits for results of all the pending write operations.
+
+        :raises ldap.LDAPError: if any of the operations failed; DN of the
+            entry is added into the error under key "dn"
+        '''
+        while self._pending:
+            self._collect()
+
+    def upsert(self, dn, attrs, callback=None):
+        '''Updates the entry or inserts it when doesn't exist yet.
+
+        :param callback: function to call with the DN when the entry is
+            written (or doesn't need to be)
+        :returns: True if the entry is changed, False otherwise
+        '''
+        key = normalize_dn(dn)
+        if key in self._entries:
+            old_attrs = self._entries[key]
+        else:
+            try:
+                old_attrs = self._conn.search_s(dn, ldap.SCOPE_BASE)[0][1]
+            except ldap.NO_SUCH_OBJECT:
+                old_attrs = None
+
+        # remember the new state for another record of the same DN
+        if old_attrs is None:
+            changed = self.insert(dn, attrs, callback)
+            self._entries[key] = attrs
+            if self.dryrun: self._dryrun_write(dn, attrs, True)
+        else:
+            changed = self.update(dn, old_attrs, attrs, callback)
+            if self.dryrun: self._dryrun_write(dn, attrs, self.remove_unset_attrs)
+            if not self.remove_unset_attrs:
+                names = set(name.lower() for name in attrs)
+                attrs = dict([(k, v) for k, v in old_attrs.items() if k.lower() not in names]
+                             + attrs.items())
+            self._entries[key] = attrs
 
         return changed
 
     def upsert_all(self, records):
         '''Updates existing entries or inserts new ones when doesn't exist yet.
+        The records are processed in batches of batch_size; change records
+        are executed in between as they come.
 
-        :param records: list of entries to update or insert; each item must be
-            a tuple with DN and a hash of attributes
+        :param records: iterable of entries to update or insert; each item
+            must be a tuple with DN and a hash of attributes, or a ChangeRecord
         :returns: True if any entry was changed, False otherwise
         '''
+        if self._params.get('normalize_values') and self.matching_rules is None:
+            self.matching_rules = self.load_matching_rules(self._params.get('cache_dir'))
+
         changed = False
-        for (dn, attrs) in records:
-            if self.upsert(dn, attrs): changed = True
+        batch = []
+        applied = []
+        try:
+            for dn, entry in records:
+                if isinstance(entry, ChangeRecord):
+                    if batch and self._upsert_batch(batch): changed = True
+                    batch = []
+                    self.change(dn, entry, applied.append)
+                    continue
+                batch.append((dn, entry))
+                if len(batch) >= self.batch_size:
+                    if self._upsert_batch(batch): changed = True
+                    batch = []
+            if batch and self._upsert_batch(batch): changed = True
+            self.flush()
+        finally:
+            if self.journal and not self.dryrun:
+                self.journal.save()
+
+        return changed or bool(applied)
+
+    def _upsert_batch(self, records):
+        '''Upserts the records, parents before children.
+
+        :param records: list of tuples with DN and a hash of attributes
+        :returns: True if any entry was changed, False otherwise
+        '''
+        self.flush()  # preceding change records
+        if self.journal:
+            records = self._skip_unchanged(records)
+            if not records:
+                return False
+
+        self._entries.clear()
+        attrlist = None
+        if not self.remove_unset_attrs:
+            attrlist = sorted(set(attr for dn, attrs in records for attr in attrs))
+        self.prefetch([dn for dn, attrs in records], attrlist)
+
+        roots, children = hierarchy(records)
+        if self.workers > 1 and len(records) > 1:
+            changed = self._upsert_parallel(records, roots, children)
+        else:
+            changed = False
+            stack = list(reversed(roots))
+            while stack:
+                i = stack.pop()
+                stack.extend(reversed(children[i]))
+                dn, attrs = records[i]
+                if self.upsert(dn, attrs): changed = True
+            self.flush()
+
+        if self.journal and not self.dryrun:
+            self._record(records)
 
         return changed
 
+    def _skip_unchanged(self, records):
+        '''Filters out the records that are recorded in the journal with the
+        same fingerprint and server stamp of the entry.
+
+        :param records: list of tuples with DN and a hash of attributes
+        :returns: list of the records to upsert
+        '''
+        recorded = []
+        for dn, attrs in records:
+            entry = self.journal.get(normalize_dn(dn))
+            if entry and entry[0] == fingerprint(attrs, self.remove_unset_attrs):
+                recorded.append(dn)
+        if not recorded:
+            return records
+
+        stamps = self.search_entries(recorded, STAMP_ATTRS)
+        unchanged = set(key for key, attrs in stamps.items()
+                        if attrs is not None and stamp(attrs) is not None
+                        and stamp(attrs) == self.journal.get(key)[1])
+
+        return [(dn, attrs) for dn, attrs in records if normalize_dn(dn) not in unchanged]
+
+    def _record(self, records):
+        '''Records fingerprints of the written records with the current
+        server stamps of the entries into the journal.
+
+        :param records: list of tuples with DN and a hash of attributes
+        '''
+        stamps = self.search_entries([dn for dn, attrs in records], STAMP_ATTRS)
+        for dn, attrs in records:
+            key = normalize_dn(dn)
+            server_stamp = stamps.get(key) and stamp(stamps[key])
+            if server_stamp is None:
+                self.journal.remove(key)
+            else:
+                self.journal.set(key, fingerprint(attrs, self.remove_unset_attrs), server_stamp)
+
+    def load_matching_rules(self, cache_dir=None):
+        '''Reads equality matching rules of the attribute types from the
+        server's subschema subentry. They are cached in cache_dir and read
+        again only when modifyTimestamp of the subentry changes.
+
+        :param cache_dir: directory for the cache, or None to not cache
+        :returns: hash of attribute type name or OID (in lower case) to name
+            of its equality matching rule (in lower case), empty if the schema
+            is not available
+        '''
+        try:
+            subschema_dn = self._conn.search_subschemasubentry_s()
+            if not subschema_dn:
+                return {}
+            entry = self._conn.search_s(subschema_dn, ldap.SCOPE_BASE, '(objectClass=subschema)',
+                                        ['modifyTimestamp'])
+            schema_stamp = entry and stamp(entry[0][1])
+
+            cache_file = None
+            if cache_dir and schema_stamp:
+                cache_key = hashlib.sha1('%s\n%s' % (self._params['ldap_uri'], subschema_dn))
+                cache_file = path.join(path.expanduser(cache_dir),
+                                       'schema-%s.json' % cache_key.hexdigest())
+                cached = read_json(cache_file)
+                if cached and cached.get('stamp') == schema_stamp:
+                    return cached['matching_rules']
+
+            entry = self._conn.read_subschemasubentry_s(subschema_dn, ['attributeTypes'])
+        except ldap.LDAPError:
+            return {}  # e.g. insufficient access; values are compared as is
+        if not entry:
+            return {}
+
+        schema = ldap.schema.SubSchema(entry, check_uniqueness=0)
+        rules = {}
+        for oid in schema.listall(ldap.schema.AttributeType):
+            rule = schema.get_inheritedattr(ldap.schema.AttributeType, oid, 'equality')
+            if rule:
+                attr_type = schema.get_obj(ldap.schema.AttributeType, oid)
+                for name in (oid,) + tuple(attr_type.names or ()):
+                    rules[name.lower()] = rule.lower()
+
+        if cache_file:
+            try:
+                if not path.isdir(path.dirname(cache_file)):
+                    os.makedirs(path.dirname(cache_file))
+                write_atomically(cache_file, lambda f: json.dump(
+                    {'stamp': schema_stamp, 'matching_rules': rules}, f))
+            except (IOError, OSError):
+                pass  # the cache is optional
 
-def parse_ldif(ldif):
+        return rules
+
+    def prefetch(self, dn_list, attrlist=None):
+        '''Fetches the entries with the given DN in bulk for upsert.
+
+        :param dn_list: list of DNs to fetch
+        :param attrlist: list of attributes to fetch, or None for all
+        '''
+        entries = self.search_entries(dn_list, attrlist)
+        if self.dryrun:
+            entries = dict((key, self._dryrun_state(key, attrs)) for key, attrs in entries.items())
+        self._entries.update(entries)
+
+    def search_entries(self, dn_list, attrlist=None):
+        '''Fetches the entries with the given DN in bulk. Entries with the
+        same parent are looked up by one-level searches under the parent with
+        OR filter of their RDNs, all sent at once, instead of a search for
+        each entry. Entries whose parent doesn't exist are known to not exist
+        either, unless the parent is not in dn_list (it's e.g. a suffix), then
+        they are looked up one by one.
+
+        :param dn_list: list of DNs to fetch
+        :param attrlist: list of attributes to fetch, or None for all
+        :returns: hash of normalized DN to a hash of attributes, or None if
+            the entry doesn't exist
+        '''
+        found = {}
+        children = {}
+        for dn in dn_list:
+            rdns = ldap.dn.str2dn(dn)
+            parent = normalize_dn(ldap.dn.dn2str(rdns[1:]))
+            children.setdefault(parent, {})[normalize_dn(dn)] = (dn, rdns[0])
+
+        known = set(normalize_dn(dn) for dn in dn_list)
+        pending = []
+        for parent, entries in children.items():
+            entries = entries.values()
+            for i in range(0, len(entries), PREFETCH_BATCH_SIZE):
+                batch = entries[i:i + PREFETCH_BATCH_SIZE]
+                if not parent:
+                    pending.append((parent, batch, None))
+                    continue
+                filterstr = '(|%s)' % ''.join(rdn_filter(rdn) for dn, rdn in batch)
+                msgid = self._conn.search_ext(parent, ldap.SCOPE_ONELEVEL, filterstr, attrlist)
+                pending.append((parent, batch, msgid))
+
+        for parent, batch, msgid in pending:
+            for dn, rdn in batch:
+                found[normalize_dn(dn)] = None
+            try:
+                if msgid is None:
+                    raise ldap.NO_SUCH_OBJECT
+                for dn, attrs in self._conn.result(msgid, all=1)[1]:
+                    if dn is not None:  # skip search references
+                        found[normalize_dn(dn)] = attrs
+            except (ldap.NO_SUCH_OBJECT, ldap.REFERRAL):
+                if parent in known:
+                    continue  # parent will be created, so children don't exist
+                for dn, rdn in batch:
+                    try:
+                        found[normalize_dn(dn)] = \
+                            self._conn.search_s(dn, ldap.SCOPE_BASE, attrlist=attrlist)[0][1]
+                    except ldap.NO_SUCH_OBJECT:
+                        pass
+
+        return found
+
+    def _upsert_parallel(self, records, roots, children):
+        '''Upserts the records using a pool of connections, each in its own
+        thread. A record is dispatched to the workers when its parent record
+        is written.
+
+        :param records: list of tuples with DN and a hash of attributes
+        :param roots: indexes of the records whose parent is not in records
+        :param children: hash of record index to list of its children indexes
+        :returns: True if any entry was changed, False otherwise
+        '''
+        pool = self._worker_pool()
+
+        ready = Queue()
+        for i in roots:
+            ready.put(i)
+        lock = threading.Lock()
+        remaining = [len(records)]
+        changed = []
+        errors = []
+
+        def stop():
+            for _ in pool:
+                ready.put(None)
+
+        def written(i):
+            lock.acquire()
+            try:
+                remaining[0] -= 1
+                for child in children[i]:
+                    ready.put(child)
+                if not remaining[0]:
+                    stop()
+            finally:
+                lock.release()
+
+        def work(ldapm):
+            try:
+                while not errors:
+                    if ldapm._pending:
+                        try:
+                            i = ready.get_nowait()
+                        except Empty:
+                            ldapm._collect()
+                            continue
+                    else:
+                        i = ready.get()
+                    if i is None:
+                        break
+                    dn, attrs = records[i]
+                    if ldapm.upsert(dn, attrs, lambda dn, i=i: written(i)):
+                        changed.append(dn)
+            except Exception:
+                errors.append(sys.exc_info())
+                stop()
+
+        threads = [threading.Thread(target=work, args=(ldapm,)) for ldapm in pool]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return bool(changed)
+
+    def _send(self, dn, operation, args, ignore=(), callback=None, errback=None):
+        '''Sends the asynchronous write operation, when there's a free slot
+        and no pending operation on the entry itself, its ancestor or
+        descendant (the server may process them in any order).
+
+        :param dn: DN of the entry the operation writes
+        :param operation: asynchronous method of the connection (e.g. add_ext)
+        :param args: arguments for the operation
+        :param ignore: error (class or tuple) that doesn't fail the operation
+        :param callback: function to call with the DN when the operation
+            succeeds
+        :param errback: function to call with the DN and the error when the
+            operation fails with ignored error; it returns True if it has
+            changed the entry after all, or raises an error
+        '''
+        key = normalize_dn(dn)
+        ancestors = ancestor_dns(key)
+
+        while self._pending and (len(self._pending) >= self.max_pending
+                                 or key in self._pending_dns
+                                 or key in self._pending_ancestors
+                                 or any(k in self._pending_dns for k in ancestors)):
+            self._collect()
+
+        msgid = operation(*args)
+        self._pending.append((msgid, dn, key, ancestors, ignore, callback, errback))
+        increment(self._pending_dns, key)
+        for k in ancestors:
+            increment(self._pending_ancestors, k)
+
+    def _collect(self):
+        '''Waits for result of the oldest pending write operation, so it's
+        always known which entry an error belongs to.'''
+
+        msgid, dn, key, ancestors, ignore, callback, errback = self._pending.popleft()
+        decrement(self._pending_dns, key)
+        for k in ancestors:
+            decrement(self._pending_ancestors, k)
+        try:
+            try:
+                self._conn.result3(msgid, all=1, timeout=self._conn.timeout)
+            except ignore, e:
+                if not (errback and errback(dn, e)):
+                    return
+        except ldap.LDAPError, e:
+            if isinstance(e.message, dict):
+                e.message['dn'] = dn
+            raise
+        if callback: callback(dn)
+
+
+def ancestor_dns(dn):
+    '''
+    :param dn: DN to get ancestors of
+    :returns: list of DNs of all the ancestors, from the parent up
+    '''
+    rdns = ldap.dn.str2dn(dn)
+    return [ldap.dn.dn2str(rdns[i:]) for i in range(1, len(rdns))]
+
+
+def hierarchy(records):
+    '''Builds a tree of the records from their DNs; an entry must be written
+    after its nearest ancestor in the records and a record of the same DN
+    after the previous one.
+
+    :param records: list of tuples with DN and a hash of attributes
+    :returns: tuple of list of indexes of the records without an ancestor in
+        records, and hash of record index to list of its children indexes
+    '''
+    keys = [normalize_dn(dn) for dn, attrs in records]
+    last = {}
+    children = {}
+    for i, key in enumerate(keys):
+        children[i] = []
+        last[key] = i
+
+    roots = []
+    seen = {}
+    for i, key in enumerate(keys):
+        if key in seen:
+            children[seen[key]].append(i)
+        else:
+            parents = [last[k] for k in ancestor_dns(key) if k in last]
+            if parents:
+                children[parents[0]].append(i)
+            else:
+                roots.append(i)
+        seen[key] = i
+
+    return roots, children
+
+
+def canonicalize(matching_rules, old_attrs, new_attrs):
+    '''Replaces the new values that match an old value of the attribute by
+    its equality matching rule with the old value, and removes duplicate
+    values, so that modifyModlist doesn't see a change where the server
+    wouldn't.
+
+    :param matching_rules: hash of attribute type to matching rule, see
+        LDAPModule.load_matching_rules
+    :param old_attrs: hash of attributes of the existing entry
+    :param new_attrs: hash of attributes of the new entry
+    :returns: a new hash of attributes of the new entry
+    '''
+    old_values = dict((name.lower(), values) for name, values in old_attrs.items())
+    result = {}
+    for name, values in new_attrs.items():
+        rule = matching_rules.get(name.lower())
+        if not rule:
+            result[name] = values
+            continue
+        existing = dict((normalize_value(rule, v), v) for v in old_values.get(name.lower(), []))
+        result[name] = []
+        seen = set()
+        for value in values:
+            key = normalize_value(rule, value)
+            if key not in seen:
+                seen.add(key)
+                result[name].append(existing.get(key, value))
+
+    return result
+
+
+def effective_modlist(matching_rules, old_attrs, modlist, new_attrs=None):
+    '''Filters the modify operations down to the ones that change the entry:
+    values to add that are not present yet, values to delete that are
+    present, and replacements by different values.
+
+    :param matching_rules: hash of attribute type to matching rule, see
+        LDAPModule.load_matching_rules
+    :param old_attrs: hash of attributes of the existing entry
+    :param modlist: list of tuples of operation, attribute and values
+    :param new_attrs: hash to fill with the attributes of the entry after the
+        modification (with names in lower case), optional
+    :returns: filtered modlist
+    '''
+    current = dict((name.lower(), list(values)) for name, values in old_attrs.items())
+    result = []
+    for op, attr, values in modlist:
+        rule = matching_rules.get(attr.lower())
+        norm = lambda value: normalize_value(rule, value) if rule else value
+        existing = current.setdefault(attr.lower(), [])
+        keys = set(norm(value) for value in existing)
+
+        if op == ldap.MOD_ADD:
+            added = []
+            for value in values or []:
+                if norm(value) not in keys:
+                    keys.add(norm(value))
+                    added.append(value)
+            if added:
+                result.append((op, attr, added))
+                existing.extend(added)
+        elif op == ldap.MOD_DELETE and values is None:
+            if existing:
+                result.append((op, attr, None))
+                del existing[:]
+        elif op == ldap.MOD_DELETE:
+            values = [v for v in values if norm(v) in keys]
+            if values:
+                result.append((op, attr, values))
+                deleted = set(map(norm, values))
+                existing[:] = [v for v in existing if norm(v) not in deleted]
+        elif op == ldap.MOD_REPLACE:
+            if keys != set(map(norm, values or [])):
+                result.append((op, attr, values))
+                existing[:] = values or []
+        else:
+            result.append((op, attr, values))
+
+    if new_attrs is not None:
+        new_attrs.update(current)
+    return result
+
+
+def merge_attrs(attrs, new_attrs):
+    '''
+    :returns: hash of the attributes with the ones from new_attrs replaced
+        (names are compared case-insensitively)
+    '''
+    names = set(name.lower() for name in new_attrs)
+    return dict([(k, v) for k, v in attrs.items() if k.lower() not in names]
+                + new_attrs.items())
+
+
+def normalize_value(rule, value):
+    '''
+    :param rule: name of the equality matching rule (in lower case)
+    :param value: the attribute value
+    :returns: value in a form that is the same for all values the server
+        considers equal by the rule (approximately, see RFC 4518)
+    '''
+    if rule in ('caseignorematch', 'caseignoreia5match', 'caseignorelistmatch'):
+        return lower(' '.join(value.split()))
+    elif rule in ('caseexactmatch', 'caseexactia5match'):
+        return ' '.join(value.split())
+    elif rule == 'distinguishednamematch':
+        try:
+            return normalize_dn(value)
+        except ldap.LDAPError:
+            return value
+    elif rule == 'objectidentifiermatch':
+        return value.lower()
+    elif rule == 'numericstringmatch':
+        return ''.join(value.split())
+    elif rule == 'telephonenumbermatch':
+        return lower(''.join(value.replace('-', ' ').split()))
+    elif rule == 'integermatch':
+        try:
+            return str(int(value))
+        except ValueError:
+            return value
+    elif rule == 'booleanmatch':
+        return value.upper()
+    return value
+
+
+def lower(value):
+    '''
+    :returns: the UTF-8 encoded value in lower case
+    '''
+    try:
+        return value.decode('utf-8').lower().encode('utf-8')
+    except UnicodeError:
+        return value.lower()
+
+
+def fingerprint(attrs, remove_unset_attrs):
+    '''
+    :param attrs: hash of attributes of the entry
+    :param remove_unset_attrs: whether the attributes not in attrs are removed
+    :returns: hex digest of the attributes, independent of the order of the
+        attributes and values, and of case of the attribute names
+    '''
+    items = sorted((name.lower(), sorted(values)) for name, values in attrs.items())
+    return hashlib.sha1(repr((items, bool(remove_unset_attrs)))).hexdigest()
+
+
+def stamp(attrs):
+    '''
+    :param attrs: hash of attributes of the entry
+    :returns: value of the first of STAMP_ATTRS the entry has, or None
+    '''
+    values = dict((name.lower(), value) for name, value in attrs.items())
+    for name in STAMP_ATTRS:
+        if values.get(name.lower()):
+            return ' '.join(values[name.lower()])
+    return None
+
+
+def read_json(filename):
+    '''
+    :returns: content of the JSON file, or None if it doesn't exist or is
+        corrupted
+    '''
+    if not path.exists(filename):
+        return None
+    try:
+        f = open(filename, 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+
+def write_atomically(filename, write):
+    '''Writes a file via a temporary file in the same directory, which is then
+    renamed to filename, so readers never see it half-written.
+
+    :param write: function that writes content into the given file object
+    '''
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(filename) or '.', prefix='.tmp')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            write(f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+    except:
+        if path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def increment(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def decrement(counts, key):
+    counts[key] -= 1
+    if not counts[key]:
+        del counts[key]
+
+
+def normalize_dn(dn):
+    '''
+    :returns: DN in a canonical form for comparison; attribute types and
+        values in lower case, without insignificant spaces
+    '''
+    return ldap.dn.dn2str([[(attr.lower(), value.lower(), flags) for attr, value, flags in rdn]
+                           for rdn in ldap.dn.str2dn(dn)])
+
+
+def renamed_dn(dn, record):
+    '''
+    :param record: the modrdn ChangeRecord
+    :returns: DN of the entry after the rename
+    '''
+    parent = record.newsuperior
+    if parent is None:
+        parent = ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+    return parent and '%s,%s' % (record.newrdn, parent) or record.newrdn
+
+
+def rdn_filter(rdn):
+    '''
+    :param rdn: RDN as returned by ldap.dn.str2dn (list of tuples)
+    :returns: search filter matching entries with the RDN
+    '''
+    assertions = ''.join('(%s=%s)' % (attr, ldap.filter.escape_filter_chars(value))
+                         for attr, value, flags in rdn)
+    if len(rdn) > 1:
+        return '(&%s)' % assertions
+    return assertions
+
+
+class Journal(object):
+    '''Journal of the entries applied to the LDAP server, stored in a JSON
+    file. Each entry is recorded by its normalized DN with a fingerprint of
+    the attributes from the LDIF and the server stamp of the entry (entryCSN
+    or modifyTimestamp) after it was written. The journal is bound to the
+    LDAP URI; a journal of another server is ignored.
+    '''
+
+    def __init__(self, filename, ldap_uri):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = {'ldap_uri': ldap_uri, 'entries': {}}
+
+        data = read_json(filename)
+        if data and data.get('ldap_uri') == ldap_uri and isinstance(data.get('entries'), dict):
+            self._data['entries'] = data['entries']
+
+    def get(self, key):
+        '''
+        :returns: list with the fingerprint and server stamp of the entry, or
+            None if not recorded
+        '''
+        return self._data['entries'].get(key)
+
+    def set(self, key, fingerprint, stamp):
+        self._lock.acquire()
+        try:
+            self._data['entries'][key] = [fingerprint, stamp]
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            self._data['entries'].pop(key, None)
+        finally:
+            self._lock.release()
+
+    def save(self):
+        '''
+        :raises JournalError: if the file can't be written
+        '''
+        self._lock.acquire()
+        try:
+            directory = path.dirname(self.filename)
+            if directory and not path.isdir(directory):
+                os.makedirs(directory)
+            write_atomically(self.filename, lambda f: json.dump(self._data, f))
+        except (IOError, OSError), e:
+            raise JournalError("Failed to write the journal %s: %s" % (self.filename, e))
+        finally:
+            self._lock.release()
+
+
+class JournalError(Exception):
+    pass
+
+
+class ChangeRecord(object):
+    '''Change record of LDIF.
+
+    :ivar changetype: add, delete, modify or modrdn
+    :ivar attrs: hash of attributes of the entry to add
+    :ivar modlist: list of modify operations (tuples of operation, attribute
+        and list of values or None)
+    :ivar newrdn: new RDN of the entry to rename
+    :ivar deleteoldrdn: whether to remove the old RDN value from the entry
+    :ivar newsuperior: DN of the new parent of the entry, or None
+    '''
+
+    def __init__(self, changetype, attrs=None, modlist=None, newrdn=None, deleteoldrdn=True,
+                 newsuperior=None):
+        self.changetype = changetype
+        self.attrs = attrs
+        self.modlist = modlist
+        self.newrdn = newrdn
+        self.deleteoldrdn = deleteoldrdn
+        self.newsuperior = newsuperior
+
+
+class LDIFStreamParser(object):
+    '''LDIF parser that yields the records one by one as they are read from
+    the file, instead of collecting all of them in memory. It reads the lines
+    by itself, because LDIFParser of python-ldap doesn't provide a way to
+    read a record at a time (and older versions don't parse change records).
+
+    Iterating over it yields tuples where the first item of the tuple is DN
+    and the second one is a hash of attributes, or ChangeRecord for records
+    with changetype.
     '''
-    :param ldif: string in LDIF format to parse
-    :returns: list of tuples where the first item of the tuple is DN and the
-        second one is a hash of attributes
+
+    def __init__(self, input_file):
+        '''
+        :param input_file: file-like object with the LDIF
+        '''
+        self.version = None
+        self.line_counter = 0
+        self.records_read = 0
+        self._input_file = input_file
+        self._lines_read = 0
+        self._last_line = self._readline()
+
+    def __iter__(self):
+        k, v = self._consume_empty_lines()
+        if k == 'version':
+            self.version = int(v)
+            k, v = self._consume_empty_lines()
+
+        while k is not None:
+            if k != 'dn':
+                raise ValueError('Line %d: First line of record does not start with "dn:": %r'
+                                 % (self.line_counter, k))
+            if not is_dn(v):
+                raise ValueError('Line %d: Invalid DN: %r' % (self.line_counter, v))
+            dn, entry = v, {}
+            k, v = self._next()
+            if k == 'control':
+                raise ValueError('Line %d: Controls in change records are not supported'
+                                 % self.line_counter)
+            if k == 'changetype':
+                entry = self._parse_change(v)
+            while k is not None and not isinstance(entry, ChangeRecord):
+                entry.setdefault(k, []).append(v)
+                k, v = self._next()
+
+            yield dn, entry
+            self.records_read += 1
+            k, v = self._consume_empty_lines()
+
+    def _parse_change(self, changetype):
+        '''Parses the rest of the change record.
+
+        :returns: ChangeRecord
+        '''
+        changetype = changetype.strip().lower()
+        k, v = self._next()
+
+        if changetype == 'add':
+            attrs = {}
+            while k is not None:
+                attrs.setdefault(k, []).append(v)
+                k, v = self._next()
+            return ChangeRecord('add', attrs=attrs)
+
+        elif changetype == 'delete':
+            if k is not None:
+                raise ValueError('Line %d: Unexpected %r in delete record' % (self.line_counter, k))
+            return ChangeRecord('delete')
+
+        elif changetype in ('modrdn', 'moddn'):
+            fields = {}
+            while k is not None:
+                fields[k.lower()] = v
+                k, v = self._next()
+            if 'newrdn' not in fields:
+                raise ValueError('Line %d: Missing newrdn in modrdn record' % self.line_counter)
+            for name in ('newrdn', 'newsuperior'):
+                if name in fields and not is_dn(fields[name]):
+                    raise ValueError('Line %d: Invalid DN in %s: %r'
+                                     % (self.line_counter, name, fields[name]))
+            return ChangeRecord('modrdn', newrdn=fields['newrdn'],
+                                deleteoldrdn=fields.get('deleteoldrdn', '1').strip() != '0',
+                                newsuperior=fields.get('newsuperior'))
+
+        elif changetype == 'modify':
+            operations = {'add': ldap.MOD_ADD, 'delete': ldap.MOD_DELETE,
+                          'replace': ldap.MOD_REPLACE, 'increment': ldap.MOD_INCREMENT}
+            modlist = []
+            while k is not None:
+                if k.lower() not in operations:
+                    raise ValueError('Line %d: Invalid modify operation: %r'
+                                     % (self.line_counter, k))
+                op, attr, values = operations[k.lower()], v.strip(), []
+                k, v = self._next()
+                while k is not None and k != '-':
+                    if k.lower() != attr.lower():
+                        raise ValueError('Line %d: Attribute %r does not match %r'
+                                         % (self.line_counter, k, attr))
+                    values.append(v)
+                    k, v = self._next()
+                modlist.append((op, attr, values or None))
+                if k == '-':
+                    k, v = self._next()
+            return ChangeRecord('modify', modlist=modlist)
+
+        raise ValueError('Line %d: Invalid changetype: %r' % (self.line_counter, changetype))
+
+    def _next(self):
+        '''
+        :returns: tuple of the next attribute type and value of the record,
+            ("-", None) for the separator of modify operations, or Nones at
+            the end of the record
+        '''
+        line = self._unfold_lines()
+        if not line:
+            return None, None
+        if line == '-':
+            return '-', None
+        if ':' not in line:
+            raise ValueError('Line %d: Missing value in %r' % (self.line_counter, line))
+
+        attr_type, value = line.split(':', 1)
+        if value.startswith(':'):
+            try:
+                value = base64.b64decode(value[1:].strip())
+            except TypeError, e:
+                raise ValueError('Line %d: Invalid Base64 value of %s: %s'
+                                 % (self.line_counter, attr_type, e))
+        elif value.startswith('<'):
+            raise ValueError('Line %d: URL values are not supported' % self.line_counter)
+        else:
+            value = value.lstrip(' ')
+        return attr_type, value
+
+    def _consume_empty_lines(self):
+        '''Skips empty lines between the records.
+
+        :returns: tuple of the first attribute type and value of the next
+            record, or Nones at the end of the file
+        '''
+        while self._last_line is not None:
+            k, v = self._next()
+            if k is not None:
+                return k, v
+        return None, None
+
+    def _unfold_lines(self):
+        '''
+        :returns: the next line joined with its continuation lines, without
+            comments; empty string for an empty line, or None at the end of
+            the file (line_counter is set to its number)
+        '''
+        while self._last_line is not None:
+            lines = [self._last_line]
+            self.line_counter = self._lines_read
+            self._last_line = self._readline()
+            while self._last_line and self._last_line[0] == ' ':
+                lines.append(self._last_line[1:])
+                self._last_line = self._readline()
+            if not lines[0].startswith('#'):
+                return ''.join(lines)
+        return None
+
+    def _readline(self):
+        line = self._input_file.readline()
+        if not line:
+            return None
+        self._lines_read += 1
+        return line.rstrip('\r\n')
+
+
+def read_dn_list(source):
+    '''Reads DNs from the LDIF, or from the plain list of DNs separated by
+    a new line.
+
+    :param source: file-like object with the LDIF or list of DNs
+    :returns: generator of DNs
     '''
-    parser = LDIFRecordList(StringIO(ldif))
-    parser.parse()
+    line = source.readline()
+    while line and (not line.strip() or line.startswith('#')):
+        line = source.readline()
+    source.seek(0)
 
-    return parser.all_records
+    if line.split(':', 1)[0].strip().lower() in ('dn', 'version'):
+        return (dn for dn, attrs in LDIFStreamParser(source))
+    return (line.strip() for line in source if line.strip())
 
 
 def main():
@@ -208,38 +1575,62 @@ def main():
         argument_spec={
             'bind_dn':            {'required': True},
             'bind_password':      {'required': True},
-            'content':            {'required': True, 'no_log': True},
+            'batch_size':         {'default': 1000, 'type': 'int'},
+            'cache_dir':          {'default': '~/.cache/ansible-ldap'},
+            'content':            {'no_log': True},
+            'journal':            {},
             'ldap_uri':           {'aliases': ['ldap_url'], 'default': 'ldap://localhost:389'},
+            'normalize_values':   {'default': True, 'type': 'bool'},
             'remove_unset_attrs': {'default': False, 'type': 'bool'},
             'state':              {'default': 'present', 'choices': ['present', 'absent']},
+            'subtree':            {'default': False, 'type': 'bool'},
             'timeout':            {'default': 10, 'type': 'int'},
+            'max_pending':        {'default': 1, 'type': 'int'},
+            'workers':            {'default': 1, 'type': 'int'},
+            'remote_src':         {'default': False, 'type': 'bool'},
             'src':                {},  # used in ldap plugin runner to load content from file
         },
+        required_one_of=[['src', 'content']],
         supports_check_mode=True,
     )
-    content = module.params['content']
+    params = module.params
 
     if not HAS_PYTHON_LDAP:
         module.fail_json(msg='Could not import python module: ldap. Please install python-ldap.')
 
+    if params['remote_src'] and params['src']:
+        try:
+            source = open(params['src'], 'rb')
+        except IOError, e:
+            module.fail_json(msg=str(e))
+    else:
+        source = StringIO(params['content'] or '')
+
     ldapm = None
     changed = False
     try:
-        ldapm = LDAPModule(module.params, module.check_mode)
-        ldif = parse_ldif(content)
+        ldapm = LDAPModule(params, module.check_mode)
 
-        if module.params['state'] == 'absent':
-            dn_list = [dn for dn, attrs in ldif] or content.splitlines()
-            dn_list = [dn for dn in dn_list if dn.strip()]  # remove blanks
-            changed = ldapm.delete_all(dn_list)
+        if params['state'] == 'absent' and params['subtree']:
+            changed = ldapm.delete_subtrees(read_dn_list(source))
+        elif params['state'] == 'absent':
+            changed = ldapm.delete_all(read_dn_list(source))
         else:
-            changed = ldapm.upsert_all(ldif)
+            changed = ldapm.upsert_all(LDIFStreamParser(source))
 
     except ldap.LDAPError, e:
         module.fail_json(msg=e.message)
+    except ValueError, e:
+        module.fail_json(msg="Invalid LDIF: %s" % e)
+    except JournalError, e:
+        module.fail_json(msg=str(e))
+    except (IOError, OSError), e:
+        module.fail_json(msg="Failed to read %s: %s"
+                         % (params['remote_src'] and params['src'] or 'the content', e))
     else:
         module.exit_json(changed=changed)
     finally:
+        source.close()
         if ldapm: ldapm.close()
 
 
@@ -0,0 +1,349 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2015, Jakub Jirutka <jakub@jirutka.cz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: ldap_search
+author: Jakub Jirutka
+version_added: "never"
+short_description: Search entries in LDAP server.
+description:
+  - This module searches entries in LDAP server, similarly as C(ldapsearch) command, and returns
+    them in C(entries) or writes them into a file on the remote host.
+  - The entries are fetched page by page using the Simple Paged Results control, so only one page
+    is kept in memory when writing into a file.
+options:
+  attrs:
+    description:
+      - List of attributes to return. Use C(*) for all user attributes and C(+) for all
+        operational attributes.
+    required: false
+    default: all user attributes
+  base:
+    description:
+      - Distinguished name (DN) of the entry to start the search at.
+    required: true
+  bind_dn:
+    description:
+      - Distinguished name (DN) to bind (authenticate) to the LDAP server. When not specified,
+        the search is anonymous.
+    required: false
+  bind_password:
+    description:
+      - Password for a simple authentication.
+    required: false
+  dest:
+    description:
+      - Path of a file on the remote host to write the entries into, instead of returning them
+        in the result. The file is replaced only when the entries have been changed.
+    required: false
+  filter:
+    description:
+      - LDAP search filter.
+    required: false
+    default: (objectClass=*)
+  format:
+    description:
+      - Format of the C(dest) file; C(json) for a JSON object per line (entry), or C(ldif).
+    required: false
+    default: json
+    choices: [json, ldif]
+  ldap_uri:
+    description:
+      - URI of the LDAP server to connect to.
+    required: false
+    default: ldap://localhost:389
+  page_size:
+    description:
+      - Number of entries requested from the server at once. Set to 0 to disable paging, e.g. for
+        a server that doesn't support it.
+    required: false
+    default: 500
+  scope:
+    description:
+      - Scope of the search; only the base entry, its children, or the whole subtree.
+    required: false
+    default: subtree
+    choices: [base, onelevel, subtree]
+  sort:
+    description:
+      - List of attributes to sort the entries by on the server (Server Side Sorting control);
+        prefix the attribute with C(-) for the reverse order. It requires pyasn1.
+    required: false
+  timeout:
+    description:
+      - A limit on the number of seconds that the action will wait for a response from
+        the LDAP server.
+    required: false
+    default: 10
+notes:
+  - Entries are returned as hashes with key C(dn) and a list of values for each attribute.
+    Values that are not valid UTF-8 are encoded in Base64 and the attribute name is suffixed with
+    C(;base64).
+'''
+
+EXAMPLES = '''
+# Gather members of a group
+- ldap_search: >
+    bind_dn='cn=master,dc=encom,dc=com'
+    bind_password=top-secret
+    base='cn=users,ou=Groups,dc=encom,dc=com'
+    scope=base
+    attrs=member
+  register: users_group
+
+# Write all people sorted by uid into a file on the remote host
+- ldap_search: >
+    ldap_uri=ldaps://grid.encom.com
+    bind_dn='cn=master,dc=encom,dc=com'
+    bind_password=top-secret
+    base='ou=People,dc=encom,dc=com'
+    filter='(objectClass=inetOrgPerson)'
+    attrs=uid,cn,mail
+    sort=uid
+    dest=/var/lib/encom/people.json
+'''
+
+import base64
+import hashlib
+import os
+import stat
+import tempfile
+from os import path
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import ldap
+    from ldap.controls import SimplePagedResultsControl
+    from ldif import LDIFWriter
+    HAS_PYTHON_LDAP = True
+except ImportError:
+    HAS_PYTHON_LDAP = False
+
+try:
+    from ldap.controls.sss import SSSRequestControl
+    HAS_SSS = True
+except ImportError:
+    HAS_SSS = False  # requires pyasn1
+
+
+class LDAPSearchModule(object):
+
+    def __init__(self, params):
+        '''
+        :param params: hash of parameters
+        '''
+        self.page_size = params['page_size']
+
+        self._conn = ldap.initialize(params['ldap_uri'])
+        self._conn.protocol_version = ldap.VERSION3
+        self._conn.timeout = int(params['timeout'])
+        self._conn.network_timeout = int(params['timeout'])
+        if params['bind_dn']:
+            self._conn.simple_bind_s(params['bind_dn'], params['bind_password'])
+
+    def close(self):
+        '''Closes the LDAP connection.
+        '''
+        self._conn.unbind_s()
+
+    def search(self, base, scope, filterstr, attrlist=None, sort=None):
+        '''Searches the entries, page by page if page_size is set.
+
+        :param base: DN of the entry to start the search at
+        :param scope: one of ldap.SCOPE_*
+        :param filterstr: search filter
+        :param attrlist: list of attributes to return, or None for all
+        :param sort: list of attributes to sort the entries by on the server
+        :returns: generator of tuples with DN and a hash of attributes
+        '''
+        controls = []
+        paging = None
+        if self.page_size:
+            paging = SimplePagedResultsControl(True, size=self.page_size, cookie='')
+            controls.append(paging)
+        if sort:
+            controls.append(SSSRequestControl(True, sort))
+
+        while True:
+            msgid = self._conn.search_ext(base, scope, filterstr, attrlist,
+                                          serverctrls=controls or None)
+            rtype, rdata, rmsgid, rctrls = self._conn.result3(msgid, all=1,
+                                                              timeout=self._conn.timeout)
+            for dn, attrs in rdata:
+                if dn is not None:  # skip search references
+                    yield dn, attrs
+
+            if not paging:
+                return
+            cookies = [c.cookie for c in rctrls
+                       if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                return
+            paging.cookie = cookies[0]
+
+
+class DigestWriter(object):
+    '''File-like wrapper that feeds everything written into the digest.
+    '''
+
+    def __init__(self, f, digest):
+        self._file = f
+        self.digest = digest
+
+    def write(self, data):
+        self._file.write(data)
+        self.digest.update(data)
+
+
+def entry_to_json(dn, attrs):
+    '''
+    :returns: hash with key "dn" and the attributes; values that are not
+        valid UTF-8 are Base64 encoded under the attribute name with suffix
+        ";base64"
+    '''
+    result = {'dn': dn}
+    for name, values in attrs.items():
+        try:
+            result[name] = [v.decode('utf-8') for v in values]
+        except UnicodeError:
+            result[name + ';base64'] = [base64.b64encode(v) for v in values]
+    return result
+
+
+def spool(entries, dest, fmt, dryrun=False):
+    '''Writes the entries into the file via a temporary file, which replaces
+    the dest only if its content differs. Mode of the dest is preserved.
+
+    :param entries: iterable of tuples with DN and a hash of attributes
+    :param dest: path of the file to write
+    :param fmt: "json" for JSON lines, or "ldif"
+    :param dryrun: if True then the dest file is not replaced
+    :returns: tuple of number of the entries and True if the dest changed
+    '''
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(dest) or '.', prefix='.tmp')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            out = DigestWriter(f, hashlib.sha1())
+            count = 0
+            if fmt == 'ldif':
+                writer = LDIFWriter(out)
+                for dn, attrs in entries:
+                    writer.unparse(dn, attrs)
+                    count += 1
+            else:
+                for dn, attrs in entries:
+                    out.write(json.dumps(entry_to_json(dn, attrs), sort_keys=True) + '\n')
+                    count += 1
+        finally:
+            f.close()
+
+        changed = file_digest(dest) != out.digest.hexdigest()
+        if changed and not dryrun:
+            # mkstemp creates the file readable only by the owner
+            if path.exists(dest):
+                os.chmod(tmp, stat.S_IMODE(os.stat(dest).st_mode))
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp, 0666 & ~umask)
+            os.rename(tmp, dest)
+        return count, changed
+    finally:
+        if path.exists(tmp):
+            os.remove(tmp)
+
+
+def file_digest(filename):
+    '''
+    :returns: SHA-1 hex digest of the file, or None if it doesn't exist
+    '''
+    if not path.exists(filename):
+        return None
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def main():
+    # define module
+    module = AnsibleModule(
+        argument_spec={
+            'attrs':         {'type': 'list'},
+            'base':          {'required': True},
+            'bind_dn':       {},
+            'bind_password': {'no_log': True},
+            'dest':          {},
+            'filter':        {'default': '(objectClass=*)'},
+            'format':        {'default': 'json', 'choices': ['json', 'ldif']},
+            'ldap_uri':      {'aliases': ['ldap_url'], 'default': 'ldap://localhost:389'},
+            'page_size':     {'default': 500, 'type': 'int'},
+            'scope':         {'default': 'subtree', 'choices': ['base', 'onelevel', 'subtree']},
+            'sort':          {'type': 'list'},
+            'timeout':       {'default': 10, 'type': 'int'},
+        },
+        supports_check_mode=True,
+    )
+    params = module.params
+
+    if not HAS_PYTHON_LDAP:
+        module.fail_json(msg='Could not import python module: ldap. Please install python-ldap.')
+    if params['sort'] and not HAS_SSS:
+        module.fail_json(msg='Could not import python module: pyasn1. It is required for sort.')
+
+    scope = {'base': ldap.SCOPE_BASE,
+             'onelevel': ldap.SCOPE_ONELEVEL,
+             'subtree': ldap.SCOPE_SUBTREE}[params['scope']]
+
+    ldapm = None
+    try:
+        ldapm = LDAPSearchModule(params)
+        entries = ldapm.search(params['base'], scope, params['filter'], params['attrs'],
+                               params['sort'])
+
+        if params['dest']:
+            dest = path.expanduser(params['dest'])
+            count, changed = spool(entries, dest, params['format'], module.check_mode)
+            result = dict(changed=changed, dest=dest, count=count)
+        else:
+            entries = [entry_to_json(dn, attrs) for dn, attrs in entries]
+            result = dict(changed=False, entries=entries, count=len(entries))
+
+    except ldap.LDAPError, e:
+        module.fail_json(msg=e.message)
+    except (IOError, OSError), e:
+        module.fail_json(msg="Failed to write %s: %s" % (params['dest'], e))
+    else:
+        module.exit_json(**result)
+    finally:
+        if ldapm: ldapm.close()
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+main()
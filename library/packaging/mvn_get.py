@@ -23,10 +23,10 @@ author: Jakub Jirutka
 version_added: "never"
 short_description: Downloads artifacts from Maven repository.
 description:
-  - Downloads artifacts from Maven repository. Resolves version of the artifact, but does I(not)
-    resolve its dependencies. It's intended just for fetching single artifact from repository,
-    nothing more.
-  - The remote server I(must) have direct access to the remote Maven repository.
+  - Downloads artifacts from Maven repository. Resolves version of the artifact and, when
+    requested, its transitive dependencies.
+  - The remote server I(must) have direct access to the remote Maven repository, unless
+    C(controller_download) is enabled.
   - This module requires Python 2.5+.
 options:
   name:
@@ -45,8 +45,18 @@ options:
       - ArtifactId of the artifact to download.
   version:
     description:
-      - Version of the artifact to download. When not provided, the newest
-        version in repository is resolved.
+      - Version of the artifact to download. It may be also a version range (e.g. C([1.2,2.0)),
+        C((,1.0]) or C([1.0,1.2),[1.3,))), C(RELEASE) for the newest release version or C(LATEST)
+        for the newest version; the newest matching version in the repository is resolved then.
+        When not provided, the newest version is resolved.
+      - Versions are ordered the same way as Maven does it (e.g. 1.0-alpha1 < 1.0-rc1 < 1.0 <
+        1.0-sp1 < 1.0.1 < 1.10), regardless of their order in the repository metadata.
+  snapshots:
+    description:
+      - Whether to consider SNAPSHOT versions when resolving a version range or the newest
+        version. C(RELEASE) never resolves to a SNAPSHOT.
+    choices: [ "yes", "no" ]
+    default: "no"
   classifier:
     description:
       - Classifier of the artifact to download.
@@ -54,10 +64,61 @@ options:
     description:
       - File extension of the artifact to download.
     default: jar
+  artifacts:
+    description:
+      - List of artifacts to download at once instead of a single one. Each item is either Maven
+        coordinates, or a hash with the keys C(name) (or C(group_id) and C(artifact_id)) and
+        optionally C(version), C(classifier), C(extension) and C(dest).
+      - C(version), C(classifier), C(extension) and C(dest) of the task are used for the items
+        that don't specify them; C(dest) should be a directory then.
+      - The result contains C(results) with a result for each of the artifacts.
+      - This option is mutually exclusive with C(name) and C(group_id).
+  workers:
+    description:
+      - Maximum number of artifacts from C(artifacts) downloaded concurrently.
+    default: 4
+  resolve_dependencies:
+    description:
+      - Whether to download also the transitive dependencies of the artifact(s) into C(dest),
+        which must be a directory. They are resolved from the POMs the same way as Maven does
+        (nearest version wins, exclusions, dependencyManagement, parent POMs, imported BOMs and
+        version ranges).
+      - POMs of released versions are cached in C(cache_dir).
+      - The result contains C(dependencies) with coordinates of the resolved dependencies and
+        C(results) with a result for each of the downloaded artifacts.
+    choices: [ "yes", "no" ]
+    default: "no"
+  dependency_scopes:
+    description:
+      - Scopes of the dependencies to download when C(resolve_dependencies) is enabled.
+        The direct dependencies of the artifact are included in their own scope (also the optional
+        ones), the transitive dependencies in the scope mediated as by Maven (e.g. a C(compile)
+        dependency of a C(test) dependency is in C(test) scope).
+    default: [ compile, runtime ]
   repo_url:
     description:
-      - URL of the Maven repository to download artifact from.
+      - URL of the Maven repository to download artifact from, or list of URLs. The artifact is
+        downloaded from the first repository in the list that contains it.
+      - It may be also a C(file://) URL of a repository on the local filesystem (e.g. mounted
+        over NFS). Artifacts from it are verified against their checksum files and then hard
+        linked to C(dest) (or reflinked or copied when it's on another filesystem), so C(dest)
+        must not be modified in place.
     default: http://repo1.maven.org/maven2
+  local_repo:
+    description:
+      - Path of a local Maven repository on the remote host, e.g. C(~/.m2/repository). Released
+        artifacts (and POMs) found in it are used without any request to C(repo_url); they are
+        verified against their checksum files, if present, and hard linked (or reflinked or
+        copied) to C(dest), unless any file attribute is specified (see C(store_dir)).
+        SNAPSHOTs and version ranges are always resolved from C(repo_url).
+  repo_mirrors:
+    description:
+      - Whether the repositories in C(repo_url) are mirrors of the same repository. Metadata are
+        then requested from all of them at once and the first response is used. Artifacts are
+        downloaded from the mirror with the best response times and fewest recent errors,
+        others are tried when it fails. The statistics are kept in C(cache_dir).
+    choices: [ "yes", "no" ]
+    default: "no"
   repo_username:
     description:
       - The username for use in HTTP Basic authentication.
@@ -69,18 +130,121 @@ options:
         be used.
     aliases: [ password ]
     default: ''
+  cache_dir:
+    description:
+      - Directory on the remote host for caching metadata of the artifacts and checksums of the
+        downloaded files between runs. Set to an empty string to disable the cache.
+    default: ~/.cache/ansible-mvn_get
+  metadata_ttl:
+    description:
+      - Number of seconds for which the cached metadata (maven-metadata.xml) are considered
+        up to date. Older metadata are revalidated with a conditional request, so the repository
+        transfers them again only when they have been changed.
+    default: 0
+  metadata_cache_size:
+    description:
+      - Maximum number of metadata files kept in the cache; the least recently used are
+        evicted first.
+    default: 1000
+  store_dir:
+    description:
+      - Directory on the remote host for a store of downloaded artifacts shared by all tasks
+        that use the same C(store_dir). Artifacts are downloaded into the store and C(dest)
+        is hard linked to them (or reflinked or copied when the store is on another
+        filesystem), so an artifact needed in several destinations is downloaded only once.
+        When any file attribute (e.g. C(mode) or C(owner)) is specified, C(dest) is a copy
+        (or reflink) instead, so the attributes don't change the stored artifact.
+      - Hard linked destinations share the content with the store, so they must not be
+        modified in place.
+  store_max_size:
+    description:
+      - Maximum size of the artifacts store in megabytes. When exceeded, the least recently
+        used artifacts that are not linked to any destination are removed. C(0) means no limit.
+    default: 0
+  checksum_algorithm:
+    description:
+      - Checksum from the repository to verify the artifact with. C(auto) uses the strongest
+        one the repository provides.
+    choices: [ auto, sha512, sha256, sha1, md5 ]
+    default: auto
+  retries:
+    description:
+      - Number of times to retry the download of the artifact when the transfer fails due to
+        a network or server error. The transfer is resumed where it stopped if the repository
+        supports Range requests. When all the attempts fail, the partially downloaded file is
+        kept next to C(dest) with suffix C(.part) and resumed on the next run.
+    default: 3
+  retry_delay:
+    description:
+      - Delay in seconds before the first retry; it's doubled with each further attempt (up
+        to 60 seconds).
+    default: 1
+  segments:
+    description:
+      - Number of parts to split the artifact into and download concurrently over separate
+        connections. It can speed up the download of large artifacts over links with high
+        latency. The parts are at least 4 MiB big, smaller artifacts are downloaded in a
+        single stream, as well as when the repository doesn't support Range requests.
+      - The downloaded file is verified against the repository checksum as a whole.
+        Interrupted segmented download is not resumed on the next run.
+    default: 1
+  stats:
+    description:
+      - Whether to add C(stats) with statistics of the transfers to the result. It contains
+        timings of each HTTP request in seconds (C(dns) and C(connect), including TLS handshake,
+        for new connections, C(ttfb) as time to the first byte of the response, and C(transfer)
+        of the body), its size in C(bytes) and C(throughput) in bytes per second, totals per
+        kind of request (metadata, checksum, pom and artifact), number of HTTP C(round_trips),
+        and hits and misses of the metadata, POM and artifact caches (C(caches)).
+    choices: [ "yes", "no" ]
+    default: "no"
+  controller_download:
+    description:
+      - Whether to download the artifact on the controller and copy it to the remote hosts
+        instead of downloading it on each of them. The artifact is downloaded only once for
+        all the hosts into the C(controller) subdirectory of C(cache_dir) on the controller and
+        copied only to the hosts where the file differs. Released versions already in the
+        cache are not checked in the repository again.
+      - The cache on the controller is always used, also when C(cache_dir) is an empty string
+        (then the default directory is used).
+      - Requires the mvn_get action plugin. C(artifacts) and C(resolve_dependencies) are not
+        supported in this mode.
+    choices: [ "yes", "no" ]
+    default: "no"
+  max_transfers:
+    description:
+      - Maximum number of hosts the artifact is copied to at once when C(controller_download)
+        is enabled.
+    default: 10
+  extract_to:
+    description:
+      - Directory to extract the artifact into; it must be a zip (also jar, war or ear) or tar
+        (optionally compressed) archive. Tar archives are extracted right as they are being
+        downloaded, zip archives from the downloaded file, which is then removed (unless
+        C(dest) is specified too).
+      - Paths and hashes of the extracted files are recorded in a manifest file
+        C(.mvn_get-<filename>.json) in the directory. When the artifact is the same as the
+        extracted one and none of the extracted files has been modified or removed, nothing is
+        extracted. Files of the previously extracted version that are not in the new one are
+        removed.
+      - Only for a single artifact.
   dest:
     description:
       - Absolute path of where to download the file to.
       - If C(dest) is a directory, filename will be derived from artifactId,
       classifier and extension of the artifact.
-    required: true
+      - Required unless C(extract_to) is specified.
   state:
     choices: [ present, absent ]
     default: present
   others:
     description:
       - all arguments accepted by the M(file) module also work here
+notes:
+  - In check mode the artifact itself is never downloaded. Whether it would be changed is decided
+    from the repository checksum or, when the repository doesn't provide one, from the size and
+    modification time reported for a HEAD request. C(bytes_transferred) then reports the size
+    that would be downloaded.
 requirements: [ hashlib, urllib2, xml.etree ]
 '''
 
@@ -102,6 +266,70 @@ EXAMPLES = '''
     name=org.apache.maven:maven
     dest=/tmp
 
+- name: download multiple artifacts at once
+  mvn_get:
+    dest: /opt/app/lib
+    artifacts:
+      - org.slf4j:slf4j-api:1.7.12
+      - name: org.postgresql:postgresql:9.4-1201-jdbc41
+        dest: /opt/app/drivers
+      - group_id: commons-io
+        artifact_id: commons-io
+        version: "2.4"
+
+- name: download artifact with its runtime dependencies
+  mvn_get:
+    name: org.apache.maven:maven-core:3.2.1
+    dest: /opt/app/lib
+    resolve_dependencies: yes
+
+- name: download artifact once on the controller and copy it to all the hosts
+  mvn_get:
+    name: org.apache.maven:maven:3.2.1
+    dest: /opt/app/lib
+    controller_download: yes
+    max_transfers: 20
+
+- name: download distribution archive and extract it
+  mvn_get:
+    name: org.apache.maven:apache-maven:tar.gz:bin:3.2.1
+    extract_to: /opt/maven
+
+- name: download the newest 1.x release of artifact
+  mvn_get:
+    name: org.slf4j:slf4j-api
+    version: "[1.0,2.0)"
+    dest: /opt/app/lib
+
+- name: download artifact and report where the time was spent
+  mvn_get:
+    name: org.apache.maven:maven:3.2.1
+    dest: /tmp
+    stats: yes
+  register: result
+- debug: var=result.stats
+
+- name: download artifact from the fastest of the mirrors
+  mvn_get:
+    name: org.apache.maven:maven:3.2.1
+    dest: /tmp
+    repo_mirrors: yes
+    repo_url:
+      - https://nexus1.example.org/content/repositories/central
+      - https://nexus2.example.org/content/repositories/central
+
+- name: download artifact from the local repository if it's there
+  mvn_get:
+    name: org.apache.maven:maven:3.2.1
+    dest: /opt/app/lib
+    local_repo: ~/.m2/repository
+
+- name: download artifact from a repository on NFS
+  mvn_get:
+    name: org.apache.maven:maven:3.2.1
+    dest: /opt/app/lib
+    repo_url: file:///mnt/maven/repository
+
 - name: download SNAPSHOT version from a private Maven repository
   mvn_get: >
     name=org.apache.maven:maven:3.2.2-SNAPSHOT
@@ -112,11 +340,63 @@ EXAMPLES = '''
 '''
 
 import hashlib
+import httplib
+import os
+import re
+import socket
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
+import zipfile
+from Queue import Queue, Empty
+from StringIO import StringIO
 from base64 import b64encode
+from copy import copy
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from os import path
+from urllib import getproxies, pathname2url, proxy_bypass, url2pathname
 from urllib2 import Request, urlopen, URLError, HTTPError
+from urlparse import urljoin, urlsplit
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Size of the blocks in which artifacts are streamed to disk.
+CHUNK_SIZE = 64 * 1024
+
+# Options of the file attributes; when any is set, dest is not hard linked.
+FILE_ATTRIBUTES = ['mode', 'owner', 'group', 'seuser', 'serole', 'setype', 'selevel']
+
+# Checksum algorithms supported by Maven repositories, the strongest first.
+CHECKSUM_ALGORITHMS = ['sha512', 'sha256', 'sha1', 'md5']
+
+# Extensions and classifiers of the common dependency types.
+DEPENDENCY_TYPES = {
+    'test-jar': ('jar', 'tests'),
+    'ejb': ('jar', None),
+    'ejb-client': ('jar', 'client'),
+    'maven-plugin': ('jar', None),
+    'java-source': ('jar', 'sources'),
+    'javadoc': ('jar', 'javadoc'),
+    'bundle': ('jar', None),
+}
+
+# Reference to a property in POM.
+PROPERTY_RE = re.compile(r'\$\{([^}]+)\}')
+
+# Upper bound of the delay between retries of a failed download in seconds.
+MAX_RETRY_DELAY = 60
+
+# Minimal size of a part of the artifact in the segmented download.
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+# ioctl request to clone a file on Linux (reflink).
+FICLONE = 0x40049409
 
 
 class Artifact(object):
@@ -168,75 +448,1315 @@ class Artifact(object):
         return Artifact(g, a, v, c, t)
 
 
+class ComparableVersion(object):
+    '''Version ordered the same way as by Maven's ComparableVersion. Numbers
+    are compared numerically, known qualifiers in the order alpha < beta <
+    milestone < rc < snapshot < (release) < sp and the other ones after them
+    lexically. Trailing zeros and release qualifiers are insignificant, so
+    1 == 1.0 == 1.0.0-ga.
+
+    The version is parsed into a list of items: int for a number, str for a
+    qualifier (already in its comparable form, see _qualifier) and list for
+    the part after a dash or a number/qualifier transition.
+    '''
+
+    QUALIFIERS = ['alpha', 'beta', 'milestone', 'rc', 'snapshot', '', 'sp']
+    ALIASES = {'ga': '', 'final': '', 'release': '', 'cr': 'rc'}
+    SHORT_QUALIFIERS = {'a': 'alpha', 'b': 'beta', 'm': 'milestone'}
+    RELEASE = str(QUALIFIERS.index(''))
+
+    def __init__(self, version):
+        self.version = version
+        self.items = self._parse(version.lower())
+
+    def __cmp__(self, other):
+        return compare_version_items(self.items, other.items)
+
+    def __str__(self):
+        return self.version
+
+    def _parse(self, version):
+        items = current = []
+        lists = [items]
+        is_digit = False
+        start = 0
+
+        def sublist():
+            new = []
+            current.append(new)
+            lists.append(new)
+            return new
+
+        for i, c in enumerate(version):
+            if c in '.-':
+                if i == start:
+                    current.append(0)
+                else:
+                    current.append(self._item(is_digit, version[start:i]))
+                start = i + 1
+                if c == '-':
+                    current = sublist()
+            elif c.isdigit():
+                if not is_digit and i > start:
+                    current.append(self._item(False, version[start:i], True))
+                    start = i
+                    current = sublist()
+                is_digit = True
+            else:
+                if is_digit and i > start:
+                    current.append(self._item(True, version[start:i]))
+                    start = i
+                    current = sublist()
+                is_digit = False
+
+        if len(version) > start:
+            current.append(self._item(is_digit, version[start:]))
+
+        for lst in reversed(lists):
+            # strip trailing "null" items (0, release qualifier, empty list)
+            for i in range(len(lst) - 1, -1, -1):
+                if lst[i] in (0, self.RELEASE, []):
+                    del lst[i]
+                elif not isinstance(lst[i], list):
+                    break
+        return items
+
+    def _item(self, is_digit, value, followed_by_digit=False):
+        if is_digit:
+            return int(value)
+        if followed_by_digit and len(value) == 1:
+            value = self.SHORT_QUALIFIERS.get(value, value)
+        return self._qualifier(self.ALIASES.get(value, value))
+
+    def _qualifier(self, value):
+        if value in self.QUALIFIERS:
+            return str(self.QUALIFIERS.index(value))
+        return '%d-%s' % (len(self.QUALIFIERS), value)
+
+
+class MetadataCache(object):
+    '''Cache of parsed maven-metadata.xml files on the local disk, stored as
+    JSON files named by hash of the URL. Entries younger than ttl seconds are
+    used as they are, the older ones are revalidated by the downloader. The
+    least recently used entries are evicted when there are more than
+    max_entries of them. When directory is None, nothing is cached; when
+    readonly (in check mode), the cache is used, but not modified.
+    '''
+
+    def __init__(self, directory, ttl=0, max_entries=1000, readonly=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.readonly = readonly
+        self._lock = threading.Lock()
+
+        if directory and not readonly and not path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, url):
+        if not self.directory:
+            return None
+        filename = self._filename(url)
+        try:
+            f = open(filename, 'r')
+            try:
+                entry = json.load(f)
+            finally:
+                f.close()
+            if not self.readonly:
+                os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry.get('url') == url and entry or None
+
+    def put(self, url, entry):
+        if not self.directory or self.readonly:
+            return
+        entry = dict(entry, url=url)
+        write_atomically(self._filename(url), lambda f: json.dump(entry, f))
+        self._evict()
+
+    def is_fresh(self, entry):
+        return time.time() - entry.get('checked', 0) < self.ttl
+
+    def _evict(self):
+        self._lock.acquire()
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith('.json')]
+            if len(names) <= self.max_entries:
+                return
+            files = [path.join(self.directory, n) for n in names]
+            files.sort(key=lambda f: path.getmtime(f))
+            for f in files[:len(files) - self.max_entries]:
+                os.remove(f)
+        except OSError:
+            pass  # concurrently modified by another process
+        finally:
+            self._lock.release()
+
+    def _filename(self, url):
+        return path.join(self.directory, hashlib.sha1(url).hexdigest() + '.json')
+
+
+class ChecksumIndex(object):
+    '''Index of checksums of the downloaded files, stored in a JSON file on
+    the local disk. Files are identified by their path, size, modification
+    time and inode, so the checksum of an unchanged file costs just stat().
+    It also remembers the strongest checksum algorithm provided for each
+    artifact in a repository. When filename is None or readonly is True (in
+    check mode), the index is kept only in memory.
+    '''
+
+    def __init__(self, filename=None, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._data = {'files': {}, 'artifacts': {}}
+
+        if filename and path.exists(filename):
+            try:
+                f = open(filename, 'r')
+                try:
+                    self._data.update(json.load(f))
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                pass  # corrupted index is just rebuilt
+            self._data.pop('repositories', None)  # algorithms by repository in older versions
+
+    def digest(self, filename, algorithm):
+        '''
+        :returns: hex digest of the file, computed only if not indexed yet
+        '''
+        return self.digests(filename, [algorithm])[algorithm]
+
+    def digests(self, filename, algorithms):
+        '''
+        :returns: hash of hex digests of the file by algorithm; the ones not
+            indexed yet are computed in a single pass over the file
+        '''
+        st = os.stat(filename)
+        entry = self._data['files'].get(filename)
+        if not entry or entry['stat'] != self._stat_key(st):
+            entry = {'stat': self._stat_key(st), 'checksums': {}}
+        missing = [a for a in algorithms if a not in entry['checksums']]
+        if missing:
+            digests = update_digests(new_digests(missing), filename)
+            entry['checksums'].update((k, d.hexdigest()) for k, d in digests.items())
+            self._set(filename, entry)
+        return dict((a, entry['checksums'][a]) for a in algorithms)
+
+    def record(self, filename, checksums):
+        '''Records checksums of the file that has just been written.
+
+        :param checksums: hash of hex digests by algorithm
+        '''
+        self._set(filename, {'stat': self._stat_key(os.stat(filename)),
+                             'checksums': dict(checksums)})
+
+    def algorithm(self, artifact_url):
+        '''
+        :param artifact_url: URL of the artifact's directory in a repository
+        :returns: the strongest checksum algorithm seen for the artifact, or
+            None if unknown
+        '''
+        return self._data['artifacts'].get(artifact_url)
+
+    def set_algorithm(self, artifact_url, algorithm):
+        self._lock.acquire()
+        try:
+            self._data['artifacts'][artifact_url] = algorithm
+        finally:
+            self._lock.release()
+
+    def save(self):
+        '''Writes the index, without the files that don't exist anymore.
+        '''
+        if not self.filename or self.readonly:
+            return
+        self._lock.acquire()
+        try:
+            files = self._data['files']
+            for filename in [f for f in files if not path.exists(f)]:
+                del files[filename]
+            write_atomically(self.filename, lambda f: json.dump(self._data, f))
+        finally:
+            self._lock.release()
+
+    def _set(self, filename, entry):
+        self._lock.acquire()
+        try:
+            self._data['files'][filename] = entry
+        finally:
+            self._lock.release()
+
+    def _stat_key(self, st):
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+
+class MirrorStats(object):
+    '''Statistics of the mirrors' response times and errors, persisted in a
+    JSON file on the local disk (only in memory when filename is None or
+    readonly is True), used to rank the mirrors for downloads.
+    '''
+
+    # Weight of a new latency sample in the moving average.
+    alpha = 0.3
+
+    # Seconds added to the mirror's score for each (recent) error.
+    error_penalty = 5.0
+
+    def __init__(self, filename=None, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._stats = {}
+
+        if filename and path.exists(filename):
+            try:
+                f = open(filename, 'r')
+                try:
+                    self._stats = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                pass
+
+    def rank(self, bases):
+        '''
+        :returns: the bases ordered from the best to the worst; mirrors without
+            any statistics go first to be measured
+        '''
+        def score(base):
+            stats = self._stats.get(base, {})
+            return stats.get('latency', 0) + stats.get('errors', 0) * self.error_penalty
+        return sorted(bases, key=score)
+
+    def record_latency(self, base, seconds):
+        self._lock.acquire()
+        try:
+            stats = self._stats.setdefault(base, {})
+            if 'latency' in stats:
+                seconds = self.alpha * seconds + (1 - self.alpha) * stats['latency']
+            stats['latency'] = seconds
+            stats['errors'] = stats.get('errors', 0) / 2.0
+        finally:
+            self._lock.release()
+
+    def record_success(self, base):
+        self._lock.acquire()
+        try:
+            stats = self._stats.setdefault(base, {})
+            stats['errors'] = stats.get('errors', 0) / 2.0
+        finally:
+            self._lock.release()
+
+    def record_error(self, base):
+        self._lock.acquire()
+        try:
+            stats = self._stats.setdefault(base, {})
+            stats['errors'] = stats.get('errors', 0) + 1
+        finally:
+            self._lock.release()
+
+    def save(self):
+        if not self.filename or self.readonly or not self._stats:
+            return
+        self._lock.acquire()
+        try:
+            write_atomically(self.filename, lambda f: json.dump(self._stats, f))
+        finally:
+            self._lock.release()
+
+
+class ArtifactStore(object):
+    '''Content-addressable store of artifacts on the local disk, shared by
+    all the destinations on the host. Content is stored in blobs/ under its
+    SHA-1 digest and index/ maps artifact paths in the repository (i.e.
+    coordinates with the unique version) to the blobs. Destinations are
+    linked to the blobs, so the same artifact costs no extra download or disk
+    space.
+
+    When the blobs take more than max_size bytes, the least recently used
+    ones that are not linked to any destination are removed. When readonly
+    (in check mode), the store is searched, but not modified.
+    '''
+
+    def __init__(self, directory, max_size=0, readonly=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.readonly = readonly
+        self._lock = threading.Lock()
+
+        for subdir in ('blobs', 'index'):
+            if not readonly and not path.isdir(path.join(directory, subdir)):
+                os.makedirs(path.join(directory, subdir))
+
+    def find(self, key, checksum=None):
+        '''
+        :param key: path of the artifact in the repository
+        :param checksum: tuple of algorithm and expected hex digest of the
+            artifact, if known
+        :returns: path of the blob with the artifact, or None if not stored
+        '''
+        entry = self._load(key)
+        if not entry:
+            return None
+        blob = self._blob_path(entry['sha1'])
+        if not path.exists(blob) or path.getsize(blob) != entry['size']:
+            return None
+
+        if checksum:
+            algorithm, value = checksum
+            if algorithm not in entry['checksums']:
+                entry['checksums'][algorithm] = file_digest(blob, algorithm)
+            if entry['checksums'][algorithm] != value:
+                return None
+
+        entry['used'] = time.time()
+        self._save(key, entry)
+        return blob
+
+    def checksums(self, key):
+        '''
+        :returns: hash of the stored artifact's hex digests by algorithm
+        '''
+        entry = self._load(key)
+        return entry and entry['checksums']
+
+    def staging_path(self, key):
+        '''Returns path of the file to download the artifact into before it's
+        added to the store. It's the same for the same key, so an interrupted
+        download can be resumed.
+        '''
+        return path.join(self.directory, 'blobs', '.' + hashlib.sha1(key).hexdigest())
+
+    def add(self, key, staging, checksums):
+        '''Moves the downloaded file into the store.
+
+        :param staging: path returned by staging_path
+        :param checksums: hash of the file's hex digests by algorithm; it must
+            contain at least sha1
+        :returns: path of the blob
+        '''
+        blob = self._blob_path(checksums['sha1'])
+        os.rename(staging, blob)
+        self._save(key, {'sha1': checksums['sha1'], 'checksums': checksums,
+                         'size': path.getsize(blob), 'used': time.time()})
+        return blob
+
+    def collect_garbage(self):
+        if not self.max_size or self.readonly:
+            return
+        self._lock.acquire()
+        try:
+            used = {}
+            for name in os.listdir(path.join(self.directory, 'index')):
+                entry = self._load_file(path.join(self.directory, 'index', name))
+                if entry:
+                    used[entry['sha1']] = max(used.get(entry['sha1'], 0), entry['used'])
+
+            blobs, total = [], 0
+            blobs_dir = path.join(self.directory, 'blobs')
+            for name in os.listdir(blobs_dir):
+                st = os.stat(path.join(blobs_dir, name))
+                total += st.st_size
+                # Removing a blob that is linked to a destination frees nothing.
+                if st.st_nlink == 1 and not name.startswith('.'):
+                    blobs.append((used.get(name, 0), st.st_size, name))
+
+            blobs.sort()
+            for _, size, name in blobs:
+                if total <= self.max_size:
+                    break
+                os.remove(path.join(blobs_dir, name))
+                total -= size
+        except OSError:
+            pass  # concurrently modified by another process
+        finally:
+            self._lock.release()
+
+    def _blob_path(self, sha1):
+        return path.join(self.directory, 'blobs', sha1)
+
+    def _index_path(self, key):
+        return path.join(self.directory, 'index', hashlib.sha1(key).hexdigest() + '.json')
+
+    def _load(self, key):
+        entry = self._load_file(self._index_path(key))
+        return entry and entry.get('key') == key and entry or None
+
+    def _load_file(self, filename):
+        try:
+            f = open(filename, 'r')
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, key, entry):
+        if self.readonly:
+            return
+        entry = dict(entry, key=key)
+        write_atomically(self._index_path(key), lambda f: json.dump(entry, f))
+
+
+class TransferStats(object):
+    '''Statistics of the HTTP requests made by the downloader (timings of
+    each request, transferred bytes and round trips) and of the hits and
+    misses of its caches. When not enabled, nothing is recorded.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.time()
+        self.round_trips = 0
+        self.requests = []
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def round_trip(self):
+        if self.enabled:
+            self._locked(self._add_round_trip)
+
+    def record_request(self, url, method, status, timings, size):
+        '''
+        :param timings: hash with ttfb, transfer and, for a new connection,
+            dns and connect times in seconds
+        :param size: number of bytes of the body read
+        '''
+        if not self.enabled:
+            return
+        entry = dict(url=url, method=method, status=status, kind=request_kind(url), bytes=size)
+        for k in ('dns', 'connect', 'ttfb', 'transfer'):
+            entry[k] = None
+            if k in timings:
+                entry[k] = round(timings[k], 4)
+        entry['throughput'] = throughput(size, timings.get('transfer'))
+        self._locked(lambda: self.requests.append(entry))
+
+    def record_cache(self, cache, outcome):
+        '''
+        :param cache: name of the cache, e.g. metadata
+        :param outcome: hit, miss, or revalidated (hit after a conditional request)
+        '''
+        if not self.enabled:
+            return
+
+        def add():
+            counts = self.caches.setdefault(cache, {'hit': 0, 'miss': 0, 'revalidated': 0})
+            counts[outcome] += 1
+        self._locked(add)
+
+    def summary(self):
+        '''
+        :returns: hash with the statistics for the module result
+        '''
+        kinds = {}
+        for r in self.requests:
+            k = kinds.setdefault(r['kind'], {'requests': 0, 'bytes': 0, 'time': 0.0})
+            k['requests'] += 1
+            k['bytes'] += r['bytes']
+            k['time'] += (r['ttfb'] or 0) + (r['transfer'] or 0)
+        for k in kinds.values():
+            k['time'] = round(k['time'], 4)
+
+        size = sum(r['bytes'] for r in self.requests)
+        transfer = sum(r['transfer'] or 0 for r in self.requests)
+        return {
+            'elapsed': round(time.time() - self.started, 4),
+            'round_trips': self.round_trips,
+            'bytes': size,
+            'throughput': throughput(size, transfer),
+            'kinds': kinds,
+            'caches': self.caches,
+            'requests': self.requests
+        }
+
+    def _add_round_trip(self):
+        self.round_trips += 1
+
+    def _locked(self, func):
+        self._lock.acquire()
+        try:
+            func()
+        finally:
+            self._lock.release()
+
+
+class MeasuredResponse(object):
+    '''Wrapper of a response that counts the bytes read and records the
+    request into TransferStats when it's closed.
+    '''
+
+    def __init__(self, response, stats, url, method, timings):
+        self._response = response
+        self._stats = stats
+        self._url = url
+        self._method = method
+        self._timings = timings
+        self._received = time.time()
+        self._size = 0
+        self.code = response.code
+        self.msg = response.msg
+
+    def info(self):
+        return self._response.info()
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        self._size += len(data)
+        return data
+
+    def close(self):
+        if self._stats:
+            self._timings['transfer'] = time.time() - self._received
+            self._stats.record_request(self._url, self._method, self.code, self._timings, self._size)
+            self._stats = None
+        self._response.close()
+
+
+class FileResponse(object):
+    '''Response for a file:// URL with the same interface as PooledResponse.
+
+    :raises HTTPError: with status 404 if the file doesn't exist, so missing
+        files in a local repository are handled the same way as remote ones
+    '''
+
+    def __init__(self, url, method):
+        filename = url_to_path(url)
+        if not path.isfile(filename):
+            raise HTTPError(url, 404, 'Not Found', {}, None)
+        st = os.stat(filename)
+        self.code = 200
+        self.msg = 'OK'
+        self._headers = {'Content-Length': str(st.st_size),
+                         'Last-Modified': formatdate(st.st_mtime, usegmt=True)}
+        self._file = None
+        if method != 'HEAD':
+            self._file = open(filename, 'rb')
+
+    def info(self):
+        return self._headers
+
+    def read(self, amt=None):
+        if not self._file:
+            return ''
+        if amt is None:
+            return self._file.read()
+        return self._file.read(amt)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class ConnectionPool(object):
+    '''Keeps idle HTTP connections per host, so subsequent requests to the
+    same repository reuse them instead of making new TCP and TLS handshakes.
+    It's safe to use from multiple threads; each connection is used by only one
+    request at a time.
+    '''
+
+    max_redirects = 5
+
+    def __init__(self, stats=None):
+        self.stats = stats or TransferStats(False)
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._proxies = getproxies()
+
+    def urlopen(self, url, headers, method='GET'):
+        '''Sends request and follows redirects. file:// URLs are read directly
+        from the disk. Requests that should go through a proxy, or use other
+        scheme than HTTP(S), are passed to urllib2.
+
+        :raises HTTPError: if the server responds with an error status
+        :raises URLError: if the server can't be reached
+        '''
+        for _ in range(self.max_redirects + 1):
+            scheme, netloc = urlsplit(url)[0:2]
+            timings = {}
+            if scheme == 'file':
+                return FileResponse(url, method)
+            if scheme not in ('http', 'https') or self._uses_proxy(scheme, netloc):
+                req = Request(url, None, headers)
+                req.get_method = lambda: method
+                self.stats.round_trip()
+                started = time.time()
+                response = urlopen(req)
+                timings['ttfb'] = time.time() - started
+                return self._measured(response, url, method, timings)
+
+            response = self._open(url, headers, method, timings)
+            location = response.info().get('Location')
+
+            if response.code in (301, 302, 303, 307, 308) and location:
+                self._measured(response, url, method, timings).close()
+                url = urljoin(url, location)
+                if response.code == 303 and method != 'HEAD':
+                    method = 'GET'
+            elif response.code >= 400:
+                self._measured(response, url, method, timings).close()
+                raise HTTPError(url, response.code, response.msg, response.info(), None)
+            else:
+                return self._measured(response, url, method, timings)
+
+        raise URLError('too many redirects')
+
+    def close(self):
+        '''Closes all idle connections.
+        '''
+        self._lock.acquire()
+        try:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+    def _open(self, url, headers, method, timings):
+        '''
+        :param timings: hash to store timings of the request into
+        '''
+        scheme, netloc, urlpath, query = urlsplit(url)[0:4]
+        key = (scheme, netloc)
+        if query:
+            urlpath += '?' + query
+
+        conn = self._acquire(key)
+        reused = conn is not None
+        while True:
+            try:
+                conn = conn or self._connect(key, timings)
+                self.stats.round_trip()
+                started = time.time()
+                conn.request(method, urlpath or '/', None, headers)
+                response = conn.getresponse()
+                timings['ttfb'] = time.time() - started
+                return PooledResponse(self, key, conn, response)
+            except (socket.error, httplib.HTTPException), e:
+                conn and conn.close()
+                # An idle connection may have been closed by the server
+                # meanwhile, so try once again with a new one.
+                if not reused:
+                    raise URLError(e)
+                conn, reused = None, False
+
+    def _connect(self, key, timings):
+        scheme, netloc = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc)
+        else:
+            conn = httplib.HTTPConnection(netloc)
+
+        if self.stats.enabled:
+            # Connect eagerly to measure the name resolution and the handshakes
+            # (TCP and TLS) apart from the request itself.
+            started = time.time()
+            socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+            timings['dns'] = time.time() - started
+            started = time.time()
+            conn.connect()
+            timings['connect'] = time.time() - started
+        return conn
+
+    def _measured(self, response, url, method, timings):
+        if not self.stats.enabled:
+            return response
+        return MeasuredResponse(response, self.stats, url, method, timings)
+
+    def _acquire(self, key):
+        self._lock.acquire()
+        try:
+            conns = self._idle.get(key)
+            return conns and conns.pop() or None
+        finally:
+            self._lock.release()
+
+    def _release(self, key, conn):
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
+
+    def _uses_proxy(self, scheme, netloc):
+        return scheme in self._proxies and not proxy_bypass(netloc.split(':')[0])
+
+
+class PooledResponse(object):
+    '''Response to a request made by ConnectionPool, with the same interface
+    as responses returned by urllib2. The connection is returned to the pool
+    when the response is closed after reading the whole body.
+    '''
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.code = response.status
+        self.msg = response.reason
+
+    def info(self):
+        return self._response.msg
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        if not self._conn:
+            return
+        r = self._response
+        if not r.isclosed() and r.length == 0:
+            r.read()
+        if r.isclosed() and not r.will_close:
+            self._pool._release(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+
 class MavenDownloader:
 
-    def __init__(self, base, username=None, password=None):
-        if base.endswith('/'):
-            base = base[0:-1]
-        self.base = base
+    def __init__(self, base, username=None, password=None, metadata_cache=None, store=None,
+                 retries=0, retry_delay=1, segments=1, checksum_index=None,
+                 checksum_algorithm='auto', mirrors=False, mirror_stats=None, snapshots=False,
+                 stats=None, local_repo=None, hardlinks=True):
+        '''
+        :param base: URL of the repository, or list of URLs of repositories
+            to try in the given order
+        :param mirrors: whether the repositories are mirrors of the same one
+            that should be ranked by their performance instead of the order
+        :param snapshots: whether to consider SNAPSHOT versions when resolving
+            version ranges and the latest version
+        :param stats: TransferStats to record the requests into
+        :param local_repo: path of a local repository (e.g. ~/.m2/repository)
+            to look for released artifacts before the remote repositories
+        :param hardlinks: whether dest may be hard linked to the file in the
+            store or the local repository; otherwise it's copied (or
+            reflinked), e.g. when its attributes are changed
+        '''
+        if isinstance(base, basestring):
+            base = [base]
+        self.bases = [b.endswith('/') and b[0:-1] or b for b in base]
+        self.base = self.bases[0]
+        self.mirrors = mirrors and len(self.bases) > 1
+        self.mirror_stats = mirror_stats or MirrorStats()
         self.username = username
         self.password = password
         self.user_agent = 'Ansible'
+        self.stats = stats or TransferStats(False)
+        self.pool = ConnectionPool(self.stats)
+        self.metadata_cache = metadata_cache or MetadataCache(None)
+        self.store = store
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.segments = segments
+        self.checksums = checksum_index or ChecksumIndex()
+        self.checksum_algorithm = checksum_algorithm
+        self.snapshots = snapshots
+        self.local_repo = local_repo
+        self.hardlinks = hardlinks
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._metadata_memo = {}
+
+    def close(self):
+        self.pool.close()
+        self.checksums.save()
+        self.mirror_stats.save()
+
+    def download_all(self, items, check_mode, workers=1):
+        '''Downloads multiple artifacts concurrently; connections to the
+        repository are shared among all the downloads.
+
+        :param items: list of tuples with Artifact and destination path
+        :param workers: maximum number of artifacts downloaded at once
+        :returns: list of results in the same order as items; the result of
+            a failed download contains failed=True and msg
+        '''
+        seen = {}
+        for artifact, dest in items:
+            dest = self._dest_path(artifact, dest)
+            if dest in seen:
+                raise Error("Artifacts %s and %s would be saved to the same file %s"
+                            % (seen[dest], artifact, dest))
+            seen[dest] = artifact
+
+        def download(item):
+            return self.download(item[0], item[1], check_mode)
+
+        results = []
+        for (artifact, dest), (result, error) in zip(items, parallel_map(download, items, workers)):
+            if error:
+                result = dict(failed=True, msg=str(error), name=str(artifact))
+            results.append(result)
+        return results
 
     def download(self, artifact, dest, check_mode):
-        if path.isdir(dest):
-            dest = path.join(dest, artifact.filename())
-        elif not path.isdir(path.dirname(dest)):
-            raise Error("Destination directory %s does not exist" % dest)
+        '''Downloads the artifact from the first repository that has it or,
+        when the repositories are mirrors, from the fastest healthy mirror
+        (falling back to the others when it fails). Released artifacts found
+        in the local repository are linked from there without any request.
+        '''
+        result = self._from_local_repo(artifact, dest, check_mode)
+        if result:
+            return result
+        return self._from_repositories(
+            lambda repo: repo._download_artifact(copy(artifact), dest, check_mode))
 
-        if not artifact.version:
-            artifact.version = self._find_latest_version_available(artifact)
+    def extract(self, artifact, extract_to, dest, check_mode):
+        '''Extracts the artifact (zip or tar archive) into the directory
+        extract_to, see _extract_artifact.
+        '''
+        return self._from_repositories(
+            lambda repo: repo._extract_artifact(copy(artifact), extract_to, dest, check_mode))
+
+    def resolve_version(self, artifact):
+        '''Sets version of the artifact to the newest one matching its version
+        specification (see select_version), if it's not a concrete version.
+        '''
+        if is_version_spec(artifact.version):
+            artifact.version = self._from_repositories(lambda repo: repo._select_version(artifact))
+        return artifact
+
+    def remote_checksum(self, artifact, algorithm):
+        '''
+        :returns: hex digest of the artifact by the algorithm from the first
+            repository that has the artifact, or None if it doesn't provide it
+        '''
+        def fetch(repo):
+            repo = copy(repo)
+            repo.checksum_algorithm = algorithm
+            url = repo.find_uri_for_artifact(artifact)
+            checksum = repo._remote_checksum(url)
+            if not checksum:
+                # fails if the artifact is not there, then the next repository is tried
+                repo._head(url, "Failed to download artifact %s" % artifact)
+            return checksum and checksum[1]
+        return self._from_repositories(fetch)
+
+    def fetch_pom(self, artifact):
+        '''
+        :returns: POM of the artifact parsed by parse_pom
+        '''
+        pom = Artifact(artifact.group_id, artifact.artifact_id, artifact.version, None, 'pom')
+        local = self._local_path(pom)
+        if local:
+            f = open(local, 'rb')
+            try:
+                return parse_pom(f)
+            finally:
+                f.close()
+        return self._from_repositories(lambda repo: repo._request(
+            repo.find_uri_for_artifact(pom), "Failed to download POM of %s" % pom, parse_pom))
+
+    def _from_repositories(self, func):
+        '''Calls func with downloader for each of the repositories (see
+        download for the order) until it succeeds.
+        '''
+        if self.mirrors:
+            bases = self.mirror_stats.rank(self.bases)
+        else:
+            bases = self.bases
+
+        for i, base in enumerate(bases):
+            try:
+                result = func(self._for_base(base))
+            except (ArtifactError, DownloaderError), e:
+                last = i == len(bases) - 1
+                if self.mirrors:
+                    self.mirror_stats.record_error(base)
+                    if not last and (is_not_found(e) or is_transient_error(e)):
+                        continue
+                elif not last and is_not_found(e):
+                    continue
+                raise
+            if self.mirrors:
+                self.mirror_stats.record_success(base)
+            return result
+
+    def _for_base(self, base):
+        '''Returns downloader for the repository at base that shares the
+        connections, caches and settings with this one.
+        '''
+        if base == self.base:
+            return self
+        other = copy(self)
+        other.base = base
+        return other
+
+    def _download_artifact(self, artifact, dest, check_mode):
+        dest = self._dest_path(artifact, dest)
+
+        if is_version_spec(artifact.version):
+            artifact.version = self._select_version(artifact)
 
         url = self.find_uri_for_artifact(artifact)
         info = dict(url=url, path=dest, name=str(artifact), **artifact.__dict__)
 
-        if not self._is_same_md5(dest, url + '.md5'):
-            response = self._request(url, "Failed to download artifact %s" % str(artifact),
-                                     lambda r: r)
-            if response:
-                f = open(dest, 'w')
-                try:
-                    if check_mode:
-                        response.read()
-                    else:
-                        f.write(response.read())
-                finally:
-                    f.close()
-                return dict(changed=True, **info)
-        return dict(changed=False, **info)
+        failmsg = "Failed to download artifact %s" % str(artifact)
+        remote = self._remote_checksum(url)
+        head = None
+
+        if path.exists(dest):
+            if remote:
+                uptodate = remote[1] == self.checksums.digest(dest, remote[0])
+            else:
+                head = self._head(url, failmsg)
+                uptodate = self._is_same_stat(dest, head)
+            if uptodate:
+                return dict(changed=False, bytes_transferred=0, **info)
+
+        if url.startswith('file:'):
+            source = url_to_path(url)
+            if not path.isfile(source):
+                raise DownloaderError(url, failmsg, HTTPError(url, 404, 'Not Found', {}, None))
+            if remote and self.checksums.digest(source, remote[0]) != remote[1]:
+                raise DownloaderError(url, "Checksum mismatch for %s" % url,
+                                      "expected %s %s" % (remote[0].upper(), remote[1]))
+            return self._link_local(source, dest, check_mode, info)
+
+        key = url[len(self.base) + 1:]
+        blob = self.store and self.store.find(key, remote)
+        if self.store:
+            self.stats.record_cache('store', blob and 'hit' or 'miss')
+
+        if check_mode:
+            if blob:
+                return dict(changed=True, bytes_transferred=0, **info)
+            head = head or self._head(url, failmsg)
+            return dict(changed=True, bytes_transferred=head['size'], **info)
+
+        if not self.store:
+            checksums, size = self._download(url, dest, failmsg, remote)
+        else:
+            lock = self._lock_for(key)
+            lock.acquire()
+            try:
+                # It might have been added by another thread meanwhile.
+                blob = blob or self.store.find(key, remote)
+                size = 0
+                if blob:
+                    checksums = self.store.checksums(key)
+                else:
+                    staging = self.store.staging_path(key)
+                    checksums, size = self._download(url, staging, failmsg, remote)
+                    blob = self.store.add(key, staging, checksums)
+            finally:
+                lock.release()
+            link_or_copy(blob, dest, self.hardlinks)
+            self.store.collect_garbage()
+        self.checksums.record(dest, checksums)
+
+        return dict(changed=True, md5sum=checksums['md5'], checksum=checksums['sha1'],
+                    bytes_transferred=size, **info)
+
+    def _from_local_repo(self, artifact, dest, check_mode):
+        '''Links the artifact from the local repository, if it's there and
+        matches its checksum file (when present).
+
+        :returns: result of the download, or None if not found
+        '''
+        source = self._local_path(artifact)
+        if not source:
+            return None
+
+        dest = self._dest_path(artifact, dest)
+        info = dict(url=path_to_url(source), path=dest, name=str(artifact), **artifact.__dict__)
+        expected = local_checksum(source)
+        if expected and self.checksums.digest(source, expected[0]) != expected[1]:
+            return None  # corrupted, download it again
+
+        algorithm = expected and expected[0] or 'sha1'
+        if path.exists(dest) and \
+                self.checksums.digest(dest, algorithm) == self.checksums.digest(source, algorithm):
+            return dict(changed=False, bytes_transferred=0, **info)
+
+        return self._link_local(source, dest, check_mode, info)
+
+    def _local_path(self, artifact):
+        '''
+        :returns: path of the released artifact in the local repository, or
+            None if it's not there
+        '''
+        if not self.local_repo or is_version_spec(artifact.version) or artifact.is_snapshot():
+            return None
+        filename = path.join(self.local_repo, artifact.path(), "%s-%s%s.%s" % (
+            artifact.artifact_id, artifact.version,
+            artifact.classifier and '-' + artifact.classifier or '', artifact.extension))
+        return path.isfile(filename) and filename or None
+
+    def _link_local(self, source, dest, check_mode, info):
+        '''Hard links dest to the verified file source in a local repository
+        (or reflinks or copies it, see link_or_copy).
+        '''
+        if check_mode:
+            return dict(changed=True, bytes_transferred=0, **info)
+
+        checksums = self.checksums.digests(source, ['md5', 'sha1'])
+        method = link_or_copy(source, dest, self.hardlinks)
+        self.checksums.record(dest, checksums)
+
+        return dict(changed=True, md5sum=checksums['md5'], checksum=checksums['sha1'],
+                    bytes_transferred=0, link=method, **info)
+
+    def _extract_artifact(self, artifact, extract_to, dest, check_mode):
+        '''Extracts the artifact into the directory extract_to. Tar archives
+        are extracted straight from the HTTP stream, zip archives from the
+        downloaded file, which is then removed, unless dest is given. Paths and
+        hashes of the extracted files are recorded in a manifest in extract_to,
+        so the extraction is skipped when neither the artifact nor the files
+        have been changed since.
+        '''
+        fmt = archive_format(artifact.extension)
+        if not fmt:
+            raise ArtifactError(artifact, "Cannot extract %%(artifact)s, unsupported archive type %s"
+                                % artifact.extension)
+        if is_version_spec(artifact.version):
+            artifact.version = self._select_version(artifact)
+
+        url = self.find_uri_for_artifact(artifact)
+        info = dict(url=url, extract_to=extract_to, name=str(artifact), **artifact.__dict__)
+        failmsg = "Failed to download artifact %s" % str(artifact)
+
+        manifest_file = path.join(extract_to, '.mvn_get-%s.json' % artifact.filename())
+        manifest = load_manifest(manifest_file)
+        remote = self._remote_checksum(url)
+        head = None
+        if remote:
+            source = '%s:%s' % remote
+        else:
+            head = self._head(url, failmsg)
+            source = head['validator']
+
+        if source and manifest.get('source') == source and is_extracted(extract_to, manifest):
+            return dict(changed=False, bytes_transferred=0, files=len(manifest['files']), **info)
+
+        if check_mode:
+            head = head or self._head(url, failmsg)
+            return dict(changed=True, bytes_transferred=head['size'], **info)
+
+        if not path.isdir(extract_to):
+            os.makedirs(extract_to)
+
+        if fmt == 'tar' and not dest:
+            files, transferred = self._extract_stream(url, extract_to, failmsg, remote)
+        else:
+            tmp = None
+            if dest:
+                result = self._download_artifact(copy(artifact), dest, False)
+                archive, transferred = result['path'], result['bytes_transferred']
+            else:
+                fd, tmp = tempfile.mkstemp(dir=extract_to, prefix='.tmp')
+                os.close(fd)
+                archive, transferred = tmp, self._download(url, tmp, failmsg, remote)[1]
+            try:
+                files = extract_archive(fmt, archive, extract_to)
+            finally:
+                if tmp and path.exists(tmp):
+                    os.remove(tmp)
+
+        # Remove files of the previous version that are not in the new one.
+        for name in set(manifest.get('files', {})) - set(files):
+            filename = path.join(extract_to, name)
+            if path.isfile(filename) or path.islink(filename):
+                os.remove(filename)
+
+        write_atomically(manifest_file, lambda f: json.dump(
+            {'artifact': str(artifact), 'url': url, 'source': source, 'files': files}, f))
+
+        return dict(changed=True, bytes_transferred=transferred, files=len(files), **info)
+
+    def _extract_stream(self, url, extract_to, failmsg, expected=None):
+        '''Extracts tar archive at url into the directory extract_to as it's
+        being downloaded, without storing the archive itself. The archive is
+        verified when fully read; the extracted files are removed if it
+        doesn't match the expected checksum. Failed transfer is retried from
+        the beginning.
+
+        :param expected: tuple of algorithm and hex digest to verify the
+            archive against
+        :returns: tuple of hash of the extracted files (see extract_archive)
+            and number of bytes transferred
+        '''
+        algorithms = expected and [expected[0]] or []
+        state = {'transferred': 0, 'files': {}}
+
+        def receive(response):
+            reader = DigestReader(response, new_digests(algorithms))
+            try:
+                extract_tar(reader, extract_to, state['files'])
+                # tar may end before the padding, it must be read for the digest
+                for _ in iter(lambda: reader.read(CHUNK_SIZE), ''):
+                    pass
+            finally:
+                state['transferred'] += reader.size
+
+            length = response.info().get('Content-Length')
+            if length and reader.size < int(length):
+                raise httplib.IncompleteRead('', int(length) - reader.size)
+            return reader.digests
+
+        attempt = 0
+        while True:
+            try:
+                digests = self._request(url, failmsg, receive)
+                break
+            except Exception, e:
+                if not is_transient_error(e) or attempt >= self.retries:
+                    remove_extracted(extract_to, state['files'])
+                    raise
+                time.sleep(min(self.retry_delay * 2 ** attempt, MAX_RETRY_DELAY))
+                attempt += 1
+
+        if expected and digests[expected[0]].hexdigest() != expected[1]:
+            remove_extracted(extract_to, state['files'])
+            raise DownloaderError(url, "Checksum mismatch for %s" % url,
+                                  "expected %s %s, but got %s" % (expected[0].upper(), expected[1],
+                                                                  digests[expected[0]].hexdigest()))
+        return state['files'], state['transferred']
+
+    def _lock_for(self, key):
+        self._locks_lock.acquire()
+        try:
+            return self._locks.setdefault(key, threading.Lock())
+        finally:
+            self._locks_lock.release()
+
+    def _dest_path(self, artifact, dest):
+        if path.isdir(dest):
+            return path.join(dest, artifact.filename())
+        elif not path.isdir(path.dirname(dest)):
+            raise Error("Destination directory %s does not exist" % dest)
+        return dest
 
     def find_uri_for_artifact(self, artifact):
         if artifact.is_snapshot():
-            path = "/%s/maven-metadata.xml" % (artifact.path())
-            xml = self._request(self.base + path, 'Failed to download maven-metadata.xml',
-                                lambda r: ET.parse(r))
-            if not xml:
-                raise ArtifactError(artifact, "Metadata for artifact %(artifact)s not found")
-            elems = xml.findall('./versioning/snapshotVersions/snapshotVersion')
-            return self._find_matching_artifact(elems, artifact)
+            metadata = self._metadata(artifact, True)
+            return self._find_matching_artifact(metadata['snapshot_versions'], artifact)
         else:
             return self._uri_for_artifact(artifact)
 
-    def _find_latest_version_available(self, artifact):
-        path = "/%s/maven-metadata.xml" % artifact.path(False)
-        xml = self._request(self.base + path, 'Failed to download maven-metadata.xml',
-                            lambda r: ET.parse(r))
-        if not xml:
-            raise ArtifactError(artifact, "Metadata for artifact %(artifact)s not found")
-        return xml.findall('./versioning/versions/version')[-1].text
+    def _select_version(self, artifact):
+        metadata = self._metadata(artifact, False)
+        # Metadata cached by older versions of this module are not sorted.
+        versions = metadata.get('sorted_versions') or sort_versions(metadata['versions'])
+        version = select_version(versions, artifact.version, self.snapshots)
+        if not version:
+            raise ArtifactError(artifact, "No version of artifact %%(artifact)s matching %s found"
+                                % (artifact.version or 'LATEST'))
+        return version
 
-    def _find_matching_artifact(self, elems, artifact):
-        filtered = [e for e in elems if e.findtext('extension') == artifact.extension]
+    def _find_matching_artifact(self, snapshot_versions, artifact):
+        filtered = [e for e in snapshot_versions if e['extension'] == artifact.extension]
         if artifact.classifier:
-            filtered = [e for e in filtered if e.findtext('classifier') == artifact.classifier]
+            filtered = [e for e in filtered if e['classifier'] == artifact.classifier]
 
         if not len(filtered):
             raise ArtifactError(artifact, "Artifact %(artifact)s not found")
-        elem = filtered[0]
-        version = elem.findtext('value')
+        version = filtered[0]['value']
 
         return self._uri_for_artifact(artifact, version)
 
+    def _metadata(self, artifact, with_version):
+        '''Returns parsed maven-metadata.xml of the artifact (see
+        parse_metadata). It's fetched only once per run and revalidated with a
+        conditional request when cached from a previous run.
+
+        :param with_version: whether to get metadata of the artifact's version
+            (used for SNAPSHOTs) instead of the artifact itself
+        '''
+        relpath = "%s/maven-metadata.xml" % artifact.path(with_version)
+        # Mirrors share the metadata, so they are cached under the first one.
+        url = "%s/%s" % (self.mirrors and self.bases[0] or self.base, relpath)
+        if url in self._metadata_memo:
+            self.stats.record_cache('metadata', 'hit')
+            return self._metadata_memo[url]
+
+        cached = self.metadata_cache.get(url)
+        if cached and self.metadata_cache.is_fresh(cached):
+            self.stats.record_cache('metadata', 'hit')
+            metadata = cached
+        else:
+            if self.mirrors:
+                metadata = self._race(lambda base: self._fetch_metadata(base + '/' + relpath, cached))
+            else:
+                metadata = self._fetch_metadata(url, cached)
+            metadata['checked'] = time.time()
+            self.metadata_cache.put(url, metadata)
+        if metadata is not cached:
+            self.stats.record_cache('metadata', 'miss')
+
+        self._metadata_memo[url] = metadata
+        return metadata
+
+    def _race(self, func):
+        '''Calls func with base URL of each mirror concurrently and returns the
+        first successful result, without waiting for the others. The response
+        times are recorded in the mirror statistics.
+
+        :raises: error of the first failed call if all of them fail
+        '''
+        results = Queue()
+
+        def run(base):
+            started = time.time()
+            try:
+                result = func(base)
+            except Exception, e:
+                self.mirror_stats.record_error(base)
+                results.put((False, e))
+            else:
+                self.mirror_stats.record_latency(base, time.time() - started)
+                results.put((True, result))
+
+        for base in self.bases:
+            t = threading.Thread(target=run, args=(base,))
+            t.setDaemon(True)
+            t.start()
+
+        error = None
+        for _ in self.bases:
+            ok, value = results.get()
+            if ok:
+                return value
+            error = error or value
+        raise error
+
+    def _fetch_metadata(self, url, cached=None):
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        def receive(response):
+            if response.code == 304:
+                self.stats.record_cache('metadata', 'revalidated')
+                return cached
+            info = response.info()
+            metadata = parse_metadata(response)
+            metadata.update(etag=info.get('ETag'), last_modified=info.get('Last-Modified'))
+            return metadata
+        try:
+            return self._request(url, 'Failed to download maven-metadata.xml', receive, headers)
+        except DownloaderError, e:
+            # urllib2 reports Not Modified as an error.
+            if cached and getattr(e.cause, 'code', None) == 304:
+                self.stats.record_cache('metadata', 'revalidated')
+                return cached
+            raise
+
     def _uri_for_artifact(self, artifact, version=None):
         if artifact.is_snapshot() and not version:
             raise ArtifactError(artifact, 'Expected unique version for snapshot artifact')
@@ -248,43 +1768,1152 @@ class MavenDownloader:
             uri += '-' + artifact.classifier
         return uri + '.' + artifact.extension
 
-    def _request(self, url, failmsg, f):
-        headers = {'User-Agent': self.user_agent}
+    def _request(self, url, failmsg, f, headers={}, method='GET'):
+        headers = dict(headers, **{'User-Agent': self.user_agent})
         if self.username and self.password:
             credentials = b64encode(self.username + ':' + self.password)
             headers['Authorization'] = "Basic %s" % credentials
 
-        req = Request(url, None, headers)
         try:
-            response = urlopen(req)
+            response = self.pool.urlopen(url, headers, method)
         except (HTTPError, URLError), e:
             raise DownloaderError(url, failmsg, e)
-        else:
+        try:
             return f(response)
+        except (socket.error, httplib.HTTPException), e:
+            raise DownloaderError(url, failmsg, e)
+        finally:
+            response.close()
+
+    def _head(self, url, failmsg):
+        '''Asks for the metadata of the resource at url without transferring
+        its body.
+
+        :returns: dict with size, etag, last_modified (seconds since the epoch),
+            accept_ranges and validator (value for the If-Range header); the
+            values are None when not provided by the server
+        '''
+        headers = self._request(url, failmsg, lambda r: r.info(), method='HEAD')
+        size = headers.get('Content-Length')
+        etag = headers.get('ETag')
+        return dict(size=size and int(size),
+                    etag=etag,
+                    last_modified=parse_http_date(headers.get('Last-Modified')),
+                    accept_ranges=headers.get('Accept-Ranges'),
+                    validator=strong_etag(etag) or headers.get('Last-Modified'))
 
-    def _is_same_md5(self, file, remote_md5):
-        if not path.exists(file):
+    def _is_same_stat(self, file, head):
+        '''Decides whether the local file is up to date with the remote
+        resource when the repository doesn't provide a checksum.
+        '''
+        if head['size'] is None or head['last_modified'] is None:
             return False
+        st = os.stat(file)
+        return st.st_size == head['size'] and st.st_mtime >= head['last_modified']
+
+    def _download(self, url, dest, failmsg, expected=None):
+        '''Downloads the resource at url into a temporary file next to dest and
+        renames it to dest once complete and verified, so dest is never left
+        half-written.
+
+        Large resources are downloaded in self.segments parts concurrently
+        when the server supports Range requests (see _download_segmented),
+        otherwise in a single stream (see _download_stream).
+
+        :param expected: tuple of algorithm and hex digest to verify the
+            content against
+        :returns: tuple of hash of the content's hex digests by algorithm (at
+            least md5, sha1 and the expected one), and number of bytes
+            transferred (in all the attempts)
+        '''
+        tmp = dest + '.part'
+        algorithms = set(['md5', 'sha1'])
+        if expected:
+            algorithms.add(expected[0])
+        head = self.segments > 1 and self._head(url, failmsg)
+
+        if head and head['accept_ranges'] == 'bytes' and head['validator'] \
+                and head['size'] >= 2 * MIN_SEGMENT_SIZE:
+            mtime, digests, transferred = \
+                self._download_segmented(url, tmp, head, failmsg, algorithms)
+        else:
+            mtime, digests, transferred = self._download_stream(url, tmp, failmsg, algorithms)
+
+        checksums = dict((k, d.hexdigest()) for k, d in digests.items())
+        if expected and checksums[expected[0]] != expected[1]:
+            self._discard_partial(tmp)
+            raise DownloaderError(url, "Checksum mismatch for %s" % url,
+                                  "expected %s %s, but got %s" % (expected[0].upper(), expected[1],
+                                                                  checksums[expected[0]]))
+        os.rename(tmp, dest)
+        if path.exists(tmp + '.json'):
+            os.remove(tmp + '.json')
+
+        # Keep the remote timestamp so that _is_same_stat can tell whether the
+        # file is current when the repository provides no checksum.
+        if mtime:
+            os.utime(dest, (mtime, mtime))
+
+        return checksums, transferred
+
+    def _download_stream(self, url, tmp, failmsg, algorithms):
+        '''Streams the resource at url into the file tmp, computing its digests
+        on the fly.
+
+        When the transfer is interrupted, it's retried with exponential backoff
+        and resumed from where it stopped using a Range request. If all the
+        attempts fail, the partial file is kept for the next run.
+
+        :param algorithms: names of the digests to compute
+        :returns: tuple of the resource modification time, hash of the digests
+            by algorithm, and number of bytes transferred
+        '''
+        state = {'digests': None, 'transferred': 0}
+
+        def receive(response):
+            info = response.info()
+            if response.code == 206 and parse_content_range(info) == state['offset']:
+                mode = 'ab'
+            else:
+                mode, state['offset'] = 'wb', 0
+                state['digests'] = new_digests(algorithms)
+            write_atomically(tmp + '.json', lambda f: json.dump(
+                {'url': url, 'etag': info.get('ETag'), 'last_modified': info.get('Last-Modified')}, f))
+
+            f = open(tmp, mode)
+            try:
+                self._stream(response, f, *state['digests'].values())
+            finally:
+                f.close()
+                state['transferred'] += path.getsize(tmp) - state['offset']
+            return info
+
+        attempt = 0
+        while True:
+            try:
+                state['offset'], state['digests'], validator = \
+                    self._resume_state(url, tmp, state['digests'] or algorithms)
+                headers = {}
+                if state['offset']:
+                    headers = {'Range': 'bytes=%d-' % state['offset'], 'If-Range': validator}
+                info = self._request(url, failmsg, receive, headers)
+                break
+            except Exception, e:
+                if state['offset'] and getattr(getattr(e, 'cause', None), 'code', None) == 416:
+                    # The partial file is not a prefix of the resource anymore.
+                    self._discard_partial(tmp)
+                    continue
+                if not is_transient_error(e):
+                    self._discard_partial(tmp)
+                    raise
+                if attempt >= self.retries:
+                    raise
+                time.sleep(min(self.retry_delay * 2 ** attempt, MAX_RETRY_DELAY))
+                attempt += 1
+
+        mtime = parse_http_date(info.get('Last-Modified'))
+        return mtime, state['digests'], state['transferred']
+
+    def _download_segmented(self, url, tmp, head, failmsg, algorithms):
+        '''Downloads the resource at url into the file tmp in byte ranges
+        fetched concurrently, each written at its offset in the preallocated
+        file. The digests are computed from the file once complete.
+
+        :param head: result of _head for the url
+        :param algorithms: names of the digests to compute
+        :returns: tuple of the resource modification time, hash of the digests
+            by algorithm, and number of bytes transferred
+        '''
+        size = head['size']
+        count = min(self.segments, size // MIN_SEGMENT_SIZE)
+        ranges = [(i * size // count, (i + 1) * size // count - 1) for i in range(count)]
+
+        def download_range(byte_range):
+            return self._download_range(url, tmp, byte_range[0], byte_range[1],
+                                        head['validator'], failmsg)
+        try:
+            f = open(tmp, 'wb')
+            try:
+                f.truncate(size)
+            finally:
+                f.close()
+
+            results = parallel_map(download_range, ranges, count)
+            for _, error in results:
+                if error:
+                    raise error
+
+            digests = update_digests(new_digests(algorithms), tmp)
+        except:
+            self._discard_partial(tmp)
+            raise
+
+        return head['last_modified'], digests, sum(r for r, _ in results)
+
+    def _download_range(self, url, filename, start, end, validator, failmsg):
+        '''Downloads bytes start to end (inclusive) of the resource at url into
+        the same position in the existing file. Interrupted transfer is retried
+        and resumed like in _download_stream.
+
+        :param validator: ETag or Last-Modified of the resource; it must not
+            change during the download
+        :returns: number of bytes transferred
+        '''
+        state = {'pos': start, 'transferred': 0}
+
+        def receive(response):
+            if response.code != 206 or parse_content_range(response.info()) != state['pos']:
+                raise DownloaderError(url, failmsg, 'resource has been changed during download')
+            f = open(filename, 'r+b')
+            try:
+                f.seek(state['pos'])
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                    f.write(chunk)
+                    state['pos'] += len(chunk)
+                    state['transferred'] += len(chunk)
+            finally:
+                f.close()
+            if state['pos'] <= end:
+                raise httplib.IncompleteRead('', end + 1 - state['pos'])
+
+        attempt = 0
+        while True:
+            try:
+                self._request(url, failmsg, receive, {
+                    'Range': 'bytes=%d-%d' % (state['pos'], end), 'If-Range': validator})
+                return state['transferred']
+            except Exception, e:
+                if attempt >= self.retries or not is_transient_error(e):
+                    raise
+                time.sleep(min(self.retry_delay * 2 ** attempt, MAX_RETRY_DELAY))
+                attempt += 1
+
+    def _resume_state(self, url, tmp, digests):
+        '''Determines from where the download into tmp can be resumed.
+
+        :param digests: hash of digests of the content in tmp if computed by
+            a previous attempt, otherwise names of the digests to compute
+        :returns: tuple of offset, digests of the content up to the offset and
+            validator for the If-Range header
+        '''
+        saved = None
+        if path.exists(tmp):
+            try:
+                f = open(tmp + '.json', 'r')
+                try:
+                    saved = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                pass
+
+        validator = saved and (strong_etag(saved.get('etag')) or saved.get('last_modified'))
+
+        if not validator or saved.get('url') != url:
+            self._discard_partial(tmp)
+            return 0, new_digests(digests), None
+
+        if not isinstance(digests, dict):
+            digests = update_digests(new_digests(digests), tmp)
+        return path.getsize(tmp), digests, validator
+
+    def _discard_partial(self, tmp):
+        for filename in (tmp, tmp + '.json'):
+            if path.exists(filename):
+                os.remove(filename)
+
+    def _stream(self, response, f, *digests):
+        '''Copies the response body into file f (if given) and feeds it into
+        the digests chunk by chunk, so the body is never held in memory.
+
+        :returns: number of bytes read
+        :raises IncompleteRead: if the body is shorter than its declared length
+        '''
+        size = 0
+        try:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                size += len(chunk)
+                for digest in digests:
+                    digest.update(chunk)
+                if f:
+                    f.write(chunk)
+        finally:
+            response.close()
+
+        length = response.info().get('Content-Length')
+        if length and size < int(length):
+            raise httplib.IncompleteRead('', int(length) - size)
+        return size
+
+    def _remote_checksum(self, url):
+        '''Fetches checksum of the resource at url from the repository. With
+        the auto algorithm, it tries the strongest one first and remembers the
+        strongest one found for the artifact's directory (i.e. also for its POM
+        and other files of the same version) for the next time.
+
+        :returns: tuple of algorithm and hex digest, or None if the repository
+            does not provide any
+        '''
+        known = None
+        if self.checksum_algorithm != 'auto':
+            algorithms = [self.checksum_algorithm]
+        else:
+            known = self.checksums.algorithm(url.rsplit('/', 1)[0])
+            algorithms = CHECKSUM_ALGORITHMS[CHECKSUM_ALGORITHMS.index(known or 'sha512'):]
+
+        for algorithm in algorithms:
+            try:
+                value = self._request(url + '.' + algorithm, 'Failed to download checksum',
+                                      lambda r: (r.read().split() or [None])[0])
+            except DownloaderError, e:
+                if getattr(e.cause, 'code', None) == 404:
+                    continue
+                raise
+            if value:
+                if self.checksum_algorithm == 'auto' and not known:
+                    self.checksums.set_algorithm(url.rsplit('/', 1)[0], algorithm)
+                return algorithm, value.lower()
+        return None
+
+
+class DependencyResolver(object):
+    '''Resolves transitive dependencies of artifacts from their POMs like
+    Maven does: the POMs are merged with their parents, imported BOMs and
+    dependencyManagement, properties are interpolated, test, provided and
+    optional dependencies are not transitive (but the direct ones of the roots
+    are included), scopes are mediated, exclusions
+    are applied and the nearest version of an artifact wins.
+
+    The dependency graph is walked breadth-first and POMs of each level are
+    fetched concurrently. Parsed POMs of released versions are cached, so
+    the same graph is resolved offline on the next run.
+    '''
+
+    def __init__(self, downloader, pom_cache=None, workers=1):
+        self.downloader = downloader
+        self.pom_cache = pom_cache or MetadataCache(None)
+        self.workers = workers
+        self._poms = {}
+
+    def resolve(self, roots, scopes=('compile', 'runtime')):
+        '''
+        :param roots: list of Artifacts to resolve dependencies of
+        :param scopes: scopes of the dependencies to include
+        :returns: list of Artifacts; the roots followed by their dependencies
+            in breadth-first order
+        '''
+        result = []
+        roots = [self.downloader.resolve_version(a) for a in roots]
+        seen = set(dependency_key(a) for a in roots)
+        # (artifact, scope, exclusions, dependencyManagement of the root)
+        level = [(a, 'compile', (), None) for a in roots]
+
+        while level:
+            models = parallel_map(lambda node: self.effective_model(node[0]), level, self.workers)
+            next_level = []
+
+            for (artifact, scope, exclusions, management), (model, error) in zip(level, models):
+                if error:
+                    raise error
+                if artifact.extension != 'pom':
+                    result.append(artifact)
+                if management is None:
+                    management = model['management']
+
+                for dep in model['dependencies']:
+                    # dependencyManagement of the root overrides transitive dependencies
+                    managed = artifact not in roots and management.get(management_key(dep))
+                    if managed:
+                        dep = dict(dep, version=managed['version'] or dep['version'],
+                                   scope=managed['scope'] or dep['scope'])
+
+                    if artifact in roots:
+                        # direct dependencies are included in their own scope, even optional
+                        dep_scope = dep['scope'] or 'compile'
+                    else:
+                        dep_scope = mediate_scope(scope, dep['scope'] or 'compile')
+                        if dep['optional'] == 'true':
+                            continue
+                    if not dep_scope or dep_scope not in scopes:
+                        continue
+                    if is_excluded(dep, exclusions):
+                        continue
+                    child = self._make_artifact(dep, artifact)
+                    if dependency_key(child) in seen:
+                        continue  # nearer one wins
+                    seen.add(dependency_key(child))
+                    next_level.append((child, dep_scope, tuple(exclusions) + tuple(dep['exclusions']),
+                                       management))
+
+            level = next_level
+
+        return result
+
+    def effective_model(self, artifact):
+        '''
+        :returns: POM of the artifact (as parsed by parse_pom) merged with its
+            parents and imported BOMs, interpolated, and with versions and
+            scopes of the dependencies completed from dependencyManagement
+        '''
+        model = self._inherited_model(artifact.group_id, artifact.artifact_id, artifact.version, [])
+        props = dict(model['properties'])
+        for prefix in ('project.', 'pom.', ''):
+            for k in ('group_id', 'artifact_id', 'version'):
+                props[prefix + camel_case(k)] = model[k]
+        if model['parent']:
+            for k in ('group_id', 'artifact_id', 'version'):
+                props['project.parent.' + camel_case(k)] = model['parent'][k]
+
+        deps = [interpolate_dependency(d, props) for d in model['dependencies']]
+        managed = [interpolate_dependency(d, props) for d in model['dependency_management']]
+
+        management = {}
+        for dep in managed:
+            if dep['scope'] == 'import' and dep['type'] == 'pom':
+                bom = self.effective_model(Artifact(dep['group_id'], dep['artifact_id'],
+                                                    dep['version'], None, 'pom'))
+                for key, bom_dep in bom['management'].items():
+                    management.setdefault(key, bom_dep)
+            else:
+                management[management_key(dep)] = dep
+
+        for dep in deps:
+            managed_dep = management.get(management_key(dep))
+            if managed_dep:
+                for k in ('version', 'scope'):
+                    dep[k] = dep[k] or managed_dep[k]
+                dep['exclusions'] = dep['exclusions'] + managed_dep['exclusions']
+
+        return dict(model, dependencies=deps, management=management)
+
+    def _inherited_model(self, group_id, artifact_id, version, children):
+        '''
+        :returns: POM merged with its parents, not interpolated yet
+        '''
+        coords = ':'.join((group_id, artifact_id, version))
+        if coords in children:
+            raise Error("Cycle in parents of POM %s" % coords)
+
+        pom = self._pom(Artifact(group_id, artifact_id, version))
+        if not pom['parent']:
+            return pom
+
+        p = pom['parent']
+        parent = self._inherited_model(p['group_id'], p['artifact_id'], p['version'],
+                                       children + [coords])
+        return {
+            'group_id': pom['group_id'] or parent['group_id'],
+            'artifact_id': pom['artifact_id'],
+            'version': pom['version'] or parent['version'],
+            'parent': p,
+            'properties': dict(parent['properties'], **pom['properties']),
+            'dependencies': merge_dependencies(parent['dependencies'], pom['dependencies']),
+            'dependency_management': merge_dependencies(parent['dependency_management'],
+                                                        pom['dependency_management']),
+        }
+
+    def _pom(self, artifact):
+        coords = ':'.join((artifact.group_id, artifact.artifact_id, artifact.version))
+        if coords in self._poms:
+            return self._poms[coords]
+
+        pom = self.pom_cache.get(coords)
+        self.downloader.stats.record_cache('pom', pom and 'hit' or 'miss')
+        if not pom:
+            pom = self.downloader.fetch_pom(artifact)
+            # SNAPSHOTs may change, so they are always fetched again.
+            if not artifact.is_snapshot():
+                self.pom_cache.put(coords, pom)
+
+        self._poms[coords] = pom
+        return pom
+
+    def _make_artifact(self, dep, parent):
+        version = dep['version']
+        if not version:
+            raise ArtifactError(parent, "Version of dependency %s:%s of %%(artifact)s is not specified"
+                                % (dep['group_id'], dep['artifact_id']))
+        extension, classifier = DEPENDENCY_TYPES.get(dep['type'], (dep['type'], None))
+        artifact = Artifact(dep['group_id'], dep['artifact_id'], version,
+                            dep['classifier'] or classifier, extension)
+        return self.downloader.resolve_version(artifact)
+
+
+def parse_pom(source):
+    '''Parses POM, only the parts needed for resolving dependencies.
+
+    :param source: file-like object to read the XML from
+    :returns: hash with group_id, artifact_id, version, parent (hash with
+        group_id, artifact_id and version), properties, dependencies and
+        dependency_management (lists of hashes with group_id, artifact_id,
+        version, type, classifier, scope, optional and exclusions)
+    '''
+    root = ET.parse(source).getroot()
+    for elem in root.getiterator():
+        if isinstance(elem.tag, basestring):
+            elem.tag = elem.tag.split('}')[-1]  # strip namespace
+
+    def text(elem, name):
+        value = elem.findtext(name)
+        return value and value.strip() or None
+
+    def dependencies(path):
+        return [{
+            'group_id': text(e, 'groupId'),
+            'artifact_id': text(e, 'artifactId'),
+            'version': text(e, 'version'),
+            'type': text(e, 'type') or 'jar',
+            'classifier': text(e, 'classifier'),
+            'scope': text(e, 'scope'),
+            'optional': text(e, 'optional'),
+            'exclusions': [(text(x, 'groupId'), text(x, 'artifactId'))
+                           for x in e.findall('exclusions/exclusion')]
+        } for e in root.findall(path)]
+
+    parent = root.find('parent')
+    return {
+        'group_id': text(root, 'groupId'),
+        'artifact_id': text(root, 'artifactId'),
+        'version': text(root, 'version'),
+        'parent': parent is not None and dict((k, text(parent, camel_case(k)))
+                                              for k in ('group_id', 'artifact_id', 'version')),
+        'properties': dict((e.tag, (e.text or '').strip())
+                           for e in root.findall('properties/*')),
+        'dependencies': dependencies('dependencies/dependency'),
+        'dependency_management': dependencies('dependencyManagement/dependencies/dependency')
+    }
+
+
+def camel_case(name):
+    words = name.split('_')
+    return words[0] + ''.join(w.capitalize() for w in words[1:])
+
+
+def interpolate(value, props):
+    '''Replaces ${name} in value with the property; unknown are kept.
+    '''
+    for _ in range(10):  # properties may refer to other properties
+        if not value or '${' not in value:
+            break
+        value = PROPERTY_RE.sub(lambda m: props.get(m.group(1), m.group(0)), value)
+    return value
+
+
+def interpolate_dependency(dep, props):
+    dep = dict((k, isinstance(v, basestring) and interpolate(v, props) or v)
+               for k, v in dep.items())
+    dep['exclusions'] = [tuple(interpolate(v, props) for v in x) for x in dep['exclusions']]
+    return dep
+
+
+def management_key(dep):
+    return (dep['group_id'], dep['artifact_id'], dep['type'], dep['classifier'])
+
+
+def dependency_key(artifact):
+    return (artifact.group_id, artifact.artifact_id, artifact.extension, artifact.classifier)
+
+
+def merge_dependencies(parent, child):
+    '''
+    :returns: dependencies of the parent that are not overridden by the child,
+        followed by the child's ones
+    '''
+    keys = set(management_key(d) for d in child)
+    return [d for d in parent if management_key(d) not in keys] + child
+
+
+def mediate_scope(parent_scope, scope):
+    '''
+    :returns: scope of the transitive dependency with the given scope of
+        a dependency in parent_scope, or None if it's not transitive
+    '''
+    if scope not in ('compile', 'runtime'):
+        return None
+    if scope == 'runtime' or parent_scope != 'compile':
+        return parent_scope == 'compile' and 'runtime' or parent_scope
+    return 'compile'
+
+
+def is_excluded(dep, exclusions):
+    for group_id, artifact_id in exclusions:
+        if group_id in ('*', dep['group_id']) and artifact_id in ('*', dep['artifact_id']):
+            return True
+    return False
+
+
+def parallel_map(func, items, workers):
+    '''Calls func for each of the items in at most the given number of
+    threads.
+
+    :returns: list of tuples (result, exception) in the same order as items;
+        exception is None when func returned successfully
+    '''
+    results = [None] * len(items)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = (func(item), None)
+            except Exception, e:
+                results[i] = (None, e)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(items))))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def parse_metadata(source):
+    '''Parses maven-metadata.xml.
+
+    :param source: file-like object to read the XML from
+    :returns: hash with versions (list of strings), sorted_versions (the same
+        ordered by ComparableVersion) and snapshot_versions (list of hashes with
+        extension, classifier and value)
+    '''
+    xml = ET.parse(source)
+    versions = [e.text for e in xml.findall('./versioning/versions/version')]
+    return {
+        'versions': versions,
+        'sorted_versions': sort_versions(versions),
+        'snapshot_versions': [
+            dict((k, e.findtext(k)) for k in ('extension', 'classifier', 'value'))
+            for e in xml.findall('./versioning/snapshotVersions/snapshotVersion')]
+    }
+
+
+def compare_version_items(a, b):
+    '''Compares items of ComparableVersion, b may be None when the other
+    version has no more items.
+    '''
+    if isinstance(a, (int, long)):
+        if b is None:
+            return cmp(a, 0)
+        if isinstance(b, (int, long)):
+            return cmp(a, b)
+        return 1  # number is greater than qualifier and list
+    if isinstance(a, basestring):
+        if b is None:
+            return cmp(a, ComparableVersion.RELEASE)
+        if isinstance(b, basestring):
+            return cmp(a, b)
+        return -1  # qualifier is less than number and list
+    if b is None:
+        return a and compare_version_items(a[0], None) or 0
+    if not isinstance(b, list):
+        return isinstance(b, basestring) and 1 or -1
+
+    for i in range(max(len(a), len(b))):
+        if i >= len(a):
+            result = -compare_version_items(b[i], None)
+        elif i >= len(b):
+            result = compare_version_items(a[i], None)
         else:
-            local_md5 = self._local_md5(file)
-            remote = self._request(remote_md5, 'Failed to download MD5', lambda r: r.read())
-            return local_md5 == remote
+            result = compare_version_items(a[i], b[i])
+        if result:
+            return result
+    return 0
 
-    def _local_md5(self, file):
-        md5 = hashlib.md5()
-        f = open(file, 'rb')
+
+def sort_versions(versions):
+    '''
+    :returns: new list of the versions (strings) ordered by ComparableVersion
+    '''
+    return sorted(versions, key=ComparableVersion)
+
+
+def is_version_spec(version):
+    '''
+    :returns: whether the version is not a concrete version, but a range,
+        LATEST, RELEASE or nothing (the same as LATEST)
+    '''
+    return not version or version in ('LATEST', 'RELEASE') or version[0] in '[('
+
+
+def parse_version_range(spec):
+    '''Parses Maven version range, e.g. [1.0,2.0), (,1.0],[1.2,) or [1.5].
+
+    :returns: list of tuples (lower bound, lower inclusive, upper bound,
+        upper inclusive); the bounds are ComparableVersion or None if unbounded
+    :raises Error: if spec is not a valid version range
+    '''
+    ranges = []
+    rest = spec.strip()
+    while rest:
+        ends = [i for i in (rest.find(']'), rest.find(')')) if i > 0]
+        if rest[0] not in '[(' or not ends:
+            raise Error("Invalid version range %s" % spec)
+        end = min(ends)
+        bounds = [b.strip() for b in rest[1:end].split(',')]
+
+        if len(bounds) == 1 and rest[0] == '[' and rest[end] == ']' and bounds[0]:
+            version = ComparableVersion(bounds[0])
+            ranges.append((version, True, version, True))
+        elif len(bounds) == 2 and (bounds[0] or bounds[1]):
+            lower, upper = [b and ComparableVersion(b) or None for b in bounds]
+            ranges.append((lower, rest[0] == '[', upper, rest[end] == ']'))
+        else:
+            raise Error("Invalid version range %s" % spec)
+
+        rest = rest[end + 1:].strip()
+        if rest.startswith(','):
+            rest = rest[1:].strip()
+    return ranges
+
+
+def in_version_range(version, ranges):
+    '''
+    :param version: ComparableVersion
+    :param ranges: ranges as returned by parse_version_range
+    '''
+    for lower, lower_incl, upper, upper_incl in ranges:
+        if lower is not None and (version < lower or (version == lower and not lower_incl)):
+            continue
+        if upper is not None and (version > upper or (version == upper and not upper_incl)):
+            continue
+        return True
+    return False
+
+
+def select_version(versions, spec, snapshots=False):
+    '''Selects the newest version matching the specification.
+
+    :param versions: available versions sorted by ComparableVersion
+    :param spec: version range, RELEASE for the newest release version, or
+        LATEST or None for the newest version
+    :param snapshots: whether to consider SNAPSHOT versions (except for RELEASE)
+    :returns: the selected version or None if there's no matching version
+    '''
+    ranges = spec and spec[0] in '[(' and parse_version_range(spec)
+
+    for version in reversed(versions):
+        if version.endswith('SNAPSHOT') and (not snapshots or spec == 'RELEASE'):
+            continue
+        if ranges and not in_version_range(ComparableVersion(version), ranges):
+            continue
+        return version
+    return None
+
+
+def new_digests(algorithms):
+    '''
+    :param algorithms: names of the hash algorithms, e.g. sha1
+    :returns: hash of new hash objects by algorithm
+    '''
+    return dict((name, hashlib.new(name)) for name in algorithms)
+
+
+def update_digests(digests, filename):
+    '''Feeds content of the file into all the digests.
+
+    :returns: digests
+    '''
+    f = open(filename, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            for digest in digests.values():
+                digest.update(chunk)
+    finally:
+        f.close()
+    return digests
+
+
+def file_digest(filename, algorithm):
+    '''
+    :param algorithm: name of the hash algorithm, e.g. sha1
+    :returns: hex digest of the file content
+    '''
+    return update_digests(new_digests([algorithm]), filename)[algorithm].hexdigest()
+
+
+def local_checksum(filename):
+    '''
+    :returns: tuple of algorithm and hex digest from the strongest checksum
+        file next to filename, or None if there's none
+    '''
+    for algorithm in CHECKSUM_ALGORITHMS:
+        try:
+            f = open(filename + '.' + algorithm, 'r')
+        except IOError:
+            continue
         try:
-            for chunk in iter(lambda: f.read(8192), ''):
-                md5.update(chunk)
+            value = (f.read().split() or [None])[0]
         finally:
             f.close()
-        return md5.hexdigest()
+        if value:
+            return algorithm, value.lower()
+    return None
+
+
+def url_to_path(url):
+    return url2pathname(urlsplit(url)[2])
+
+
+def path_to_url(filename):
+    return 'file://' + pathname2url(path.abspath(filename))
+
+
+def link_or_copy(src, dest, hardlink=True):
+    '''Replaces dest with a hard link to src. When it's not possible (e.g. src
+    is on another filesystem) or not allowed, then with a reflink
+    (copy-on-write clone) or, as the last resort, a copy of src.
+
+    :param hardlink: whether dest may be a hard link
+    :returns: the method used; hardlink, reflink or copy
+    '''
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(dest), prefix='.tmp')
+    os.close(fd)
+    try:
+        method = None
+        if hardlink:
+            try:
+                os.remove(tmp)
+                os.link(src, tmp)
+                method = 'hardlink'
+            except OSError:
+                pass
+        if not method:
+            method = reflink_or_copy(src, tmp)
+            os.chmod(tmp, os.stat(src).st_mode & 07777)
+        os.rename(tmp, dest)
+    except:
+        if path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return method
+
+
+def reflink_or_copy(src, dest):
+    fsrc = open(src, 'rb')
+    try:
+        fdest = open(dest, 'wb')
+        try:
+            try:
+                import fcntl
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+                return 'reflink'
+            except (ImportError, IOError):
+                for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), ''):
+                    fdest.write(chunk)
+                return 'copy'
+        finally:
+            fdest.close()
+    finally:
+        fsrc.close()
+
+
+def write_atomically(filename, write):
+    '''Writes a file via a temporary file in the same directory, which is then
+    renamed to filename, so readers never see it half-written.
+
+    :param write: function that writes content into the given file object
+    '''
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(filename), prefix='.tmp')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            write(f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+    except:
+        if path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class DigestReader(object):
+    '''File-like wrapper of a response that feeds everything read from it
+    into the digests and counts the bytes.
+    '''
+
+    def __init__(self, response, digests):
+        self.response = response
+        self.digests = digests
+        self.size = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            chunk = self.response.read()
+        else:
+            chunk = self.response.read(size)
+        for digest in self.digests.values():
+            digest.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+
+def archive_format(extension):
+    '''
+    :returns: zip or tar for extension of a supported archive, otherwise None
+    '''
+    if extension in ('zip', 'jar', 'war', 'ear'):
+        return 'zip'
+    if extension in ('tar', 'tgz', 'tbz2') or (extension or '').startswith('tar.'):
+        return 'tar'
+    return None
+
+
+def extract_archive(fmt, filename, directory):
+    '''Extracts zip or tar archive into the directory.
+
+    :returns: hash of the extracted files, see extract_tar
+    '''
+    files = {}
+    if fmt == 'tar':
+        f = open(filename, 'rb')
+        try:
+            extract_tar(f, directory, files)
+        finally:
+            f.close()
+    else:
+        extract_zip(filename, directory, files)
+    return files
+
+
+def extract_tar(fileobj, directory, files):
+    '''Extracts tar archive (optionally compressed) read sequentially from
+    the file object into the directory.
+
+    :param files: hash to add the extracted files to; relative path => hash
+        with sha1 (None for links), size and mtime of the written file
+    '''
+    tar = tarfile.open(fileobj=fileobj, mode='r|*')
+    try:
+        for member in tar:
+            target = safe_join(directory, member.name)
+            check_real_parent(directory, target)
+            if member.isdir():
+                if not path.isdir(target):
+                    os.makedirs(target)
+            elif member.isfile():
+                source = tar.extractfile(member)
+                write_extracted(source, target, member.mode, member.mtime)
+                files[member.name] = extracted_entry(target)
+            elif member.issym() or member.islnk():
+                if member.islnk():
+                    safe_join(directory, member.linkname)
+                else:
+                    check_link(directory, target, member.linkname)
+                if path.islink(target) or path.isfile(target):
+                    os.remove(target)
+                tar.extract(member, directory)
+                files[member.name] = {'sha1': None}
+    finally:
+        tar.close()
+
+
+def extract_zip(filename, directory, files):
+    '''Extracts zip archive into the directory.
+
+    :param files: see extract_tar
+    '''
+    zf = zipfile.ZipFile(filename)
+    try:
+        for member in zf.infolist():
+            target = safe_join(directory, member.filename)
+            check_real_parent(directory, target)
+            if member.filename.endswith('/'):
+                if not path.isdir(target):
+                    os.makedirs(target)
+                continue
+            mode = member.external_attr >> 16 & 0777 or 0644
+            mtime = time.mktime(member.date_time + (0, 0, -1))
+            if hasattr(zf, 'open'):
+                source = zf.open(member)
+            else:  # Python 2.5, the member is read into memory
+                source = StringIO(zf.read(member.filename))
+            try:
+                write_extracted(source, target, mode, mtime)
+            finally:
+                source.close()
+            files[member.filename] = extracted_entry(target)
+    finally:
+        zf.close()
+
+
+def write_extracted(source, target, mode, mtime):
+    if not path.isdir(path.dirname(target)):
+        os.makedirs(path.dirname(target))
+    if path.islink(target):
+        os.remove(target)
+    f = open(target, 'wb')
+    try:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), ''):
+            f.write(chunk)
+    finally:
+        f.close()
+    os.chmod(target, mode & 07777)
+    os.utime(target, (mtime, mtime))
+
+
+def extracted_entry(filename):
+    st = os.stat(filename)
+    return {'sha1': file_digest(filename, 'sha1'), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def safe_join(directory, name):
+    '''
+    :returns: path of the archive member name in the directory
+    :raises Error: if the member would be extracted outside of the directory
+    '''
+    directory = path.abspath(directory)
+    target = path.normpath(path.join(directory, name))
+    if target != directory and not target.startswith(directory + os.sep):
+        raise Error("Archive member %s points outside of the destination directory" % name)
+    return target
+
+
+def check_link(directory, link, linkname):
+    '''
+    :param link: path of the symbolic link in the directory
+    :param linkname: target of the link, absolute or relative to the link
+    :raises Error: if the link would point outside of the directory
+    '''
+    directory = path.abspath(directory)
+    target = path.normpath(path.join(path.dirname(link), linkname))
+    if target != directory and not target.startswith(directory + os.sep):
+        raise Error("Archive member %s links outside of the destination directory: %s"
+                    % (link[len(directory) + 1:], linkname))
+
+
+def check_real_parent(directory, target):
+    '''Checks that the parent directory of the target doesn't lead outside of
+    the directory through a symbolic link (e.g. extracted earlier).
+
+    :raises Error: if the target would be written outside of the directory
+    '''
+    directory = path.realpath(directory)
+    parent = path.realpath(path.dirname(target))
+    if parent != directory and not parent.startswith(directory + os.sep):
+        raise Error("Archive member %s would be extracted outside of the destination directory"
+                    % path.basename(target))
+
+
+def load_manifest(filename):
+    try:
+        f = open(filename, 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+
+def is_extracted(directory, manifest):
+    '''Checks that all the files listed in the manifest exist in the
+    directory with the same content. Files are hashed only if their size or
+    mtime differ from the manifest.
+    '''
+    for name, entry in manifest.get('files', {}).items():
+        filename = path.join(directory, name)
+        if not path.lexists(filename):
+            return False
+        if entry['sha1'] is None:
+            continue  # link
+        st = os.stat(filename)
+        if (st.st_size, st.st_mtime) == (entry['size'], entry['mtime']):
+            continue
+        if st.st_size != entry['size'] or file_digest(filename, 'sha1') != entry['sha1']:
+            return False
+    return True
+
+
+def remove_extracted(directory, files):
+    for name in files:
+        filename = path.join(directory, name)
+        if path.lexists(filename):
+            os.remove(filename)
+
+
+def request_kind(url):
+    '''
+    :returns: what the url refers to: metadata, checksum, pom or artifact
+    '''
+    urlpath = urlsplit(url)[2]
+    if urlpath.endswith('/maven-metadata.xml'):
+        return 'metadata'
+    if urlpath.rsplit('.', 1)[-1] in CHECKSUM_ALGORITHMS:
+        return 'checksum'
+    if urlpath.endswith('.pom'):
+        return 'pom'
+    return 'artifact'
+
+
+def throughput(size, seconds):
+    '''
+    :returns: bytes per second, or None if not measurable
+    '''
+    if not size or not seconds:
+        return None
+    return int(size / seconds)
+
+
+def parse_content_range(headers):
+    '''
+    :returns: the first byte position from the Content-Range header, or None
+    '''
+    value = headers.get('Content-Range') or ''
+    if not value.startswith('bytes '):
+        return None
+    try:
+        return int(value[6:].split('-')[0])
+    except ValueError:
+        return None
+
+
+def is_not_found(error):
+    '''Whether the error means that the artifact is not in the repository.
+    '''
+    if isinstance(error, ArtifactError):
+        return True
+    return isinstance(error, DownloaderError) and getattr(error.cause, 'code', None) == 404
+
+
+def is_transient_error(error):
+    '''Whether the request that failed with error is worth retrying.
+    '''
+    if isinstance(error, DownloaderError):
+        error = error.cause
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+    return isinstance(error, (URLError, socket.error, httplib.HTTPException))
+
+
+def strong_etag(etag):
+    '''
+    :returns: etag if it's a strong validator (usable in If-Range), else None
+    '''
+    if etag and not etag.startswith('W/'):
+        return etag
+    return None
+
+
+def parse_http_date(value):
+    '''
+    :param value: date in the format used by HTTP headers, or None
+    :returns: seconds since the epoch, or None if value is missing or invalid
+    '''
+    date = value and parsedate_tz(value)
+    return date and mktime_tz(date)
 
 
 class Error(Exception):
 
     def __init__(self, message=None):
-        self.message
+        self.message = message
 
     def __str__(self):
         return self.message
@@ -294,7 +2923,8 @@ class ArtifactError(Error):
 
     def __init__(self, artifact, message=None):
         self.artifact = artifact
-        self.message = message.format({'artifact': artifact})
+        # the message may be already formatted, so it's not used as a format string
+        self.message = message and message.replace('%(artifact)s', str(artifact))
 
 
 class DownloaderError(Error):
@@ -308,23 +2938,100 @@ class DownloaderError(Error):
         return "%s; %s" % (self.message, str(self.cause))
 
 
+def make_artifact(spec, defaults):
+    '''Creates Artifact from the module parameters.
+
+    :param spec: Maven coordinates, or hash with the keys name, or group_id and
+        artifact_id, and optionally version, classifier and extension
+    :param defaults: hash with version, classifier and extension to use when
+        not specified in spec
+    '''
+    if not isinstance(spec, dict):
+        spec = {'name': spec}
+    opts = dict((k, spec.get(k) or defaults.get(k))
+                for k in ('version', 'classifier', 'extension'))
+
+    if spec.get('name'):
+        artifact = Artifact.parse(spec['name'])
+        artifact.version = artifact.version or opts['version']
+        artifact.classifier = artifact.classifier or opts['classifier']
+        artifact.extension = artifact.extension or opts['extension']
+    else:
+        artifact = Artifact(spec.get('group_id'), spec.get('artifact_id'), opts['version'],
+                            opts['classifier'], opts['extension'])
+    return artifact
+
+
+def make_downloader(params, cache_dir, stats=None, check_mode=False):
+    '''Creates MavenDownloader configured by the module parameters.
+
+    :param cache_dir: directory for the metadata cache, checksums index and
+        mirror statistics, or None to not cache anything
+    :param stats: TransferStats to record the requests into
+    :param check_mode: if True then the caches and the store are only read
+    :raises OSError: if failed to create the cache directories
+    '''
+    p = type('Params', (), params)
+
+    metadata_cache = MetadataCache(cache_dir and path.join(cache_dir, 'metadata'),
+                                   p.metadata_ttl, p.metadata_cache_size, check_mode)
+    store = p.store_dir and ArtifactStore(path.expanduser(p.store_dir),
+                                          p.store_max_size * 1024 * 1024, check_mode)
+    checksum_index = ChecksumIndex(cache_dir and path.join(cache_dir, 'checksums.json'),
+                                   check_mode)
+    mirror_stats = MirrorStats(cache_dir and path.join(cache_dir, 'mirrors.json'), check_mode)
+
+    return MavenDownloader(p.repo_url, p.repo_username, p.repo_password, metadata_cache, store,
+                           p.retries, p.retry_delay, p.segments, checksum_index,
+                           p.checksum_algorithm, p.repo_mirrors, mirror_stats, p.snapshots,
+                           stats, p.local_repo and path.expanduser(p.local_repo),
+                           not [k for k in FILE_ATTRIBUTES if params.get(k) is not None])
+
+
+# Options of the module, also used by the action plugin.
+ARGUMENT_SPEC = {
+    'name':          {'aliases': ['artifact']},
+    'group_id':      {},
+    'artifact_id':   {},
+    'version':       {},
+    'snapshots':     {'default': False, 'type': 'bool'},
+    'classifier':    {},
+    'extension':     {'default': 'jar'},
+    'artifacts':     {'type': 'list'},
+    'workers':       {'default': 4, 'type': 'int'},
+    'cache_dir':     {'default': '~/.cache/ansible-mvn_get'},
+    'metadata_ttl':  {'default': 0, 'type': 'int'},
+    'metadata_cache_size': {'default': 1000, 'type': 'int'},
+    'store_dir':     {},
+    'store_max_size': {'default': 0, 'type': 'int'},
+    'retries':       {'default': 3, 'type': 'int'},
+    'retry_delay':   {'default': 1, 'type': 'int'},
+    'segments':      {'default': 1, 'type': 'int'},
+    'checksum_algorithm': {'default': 'auto',
+                           'choices': ['auto'] + CHECKSUM_ALGORITHMS},
+    'resolve_dependencies': {'default': False, 'type': 'bool'},
+    'dependency_scopes': {'default': ['compile', 'runtime'], 'type': 'list'},
+    'repo_url':      {'aliases': ['repo_uri'], 'type': 'list',
+                      'default': ['http://repo1.maven.org/maven2']},
+    'repo_mirrors':  {'default': False, 'type': 'bool'},
+    'local_repo':    {},
+    'repo_username': {'aliases': ['username']},
+    'repo_password': {'aliases': ['password'], 'default': ''},
+    'stats':         {'default': False, 'type': 'bool'},
+    'controller_download': {'default': False, 'type': 'bool'},
+    'max_transfers': {'default': 10, 'type': 'int'},
+    'extract_to':    {},
+    'dest':          {},
+    'state':         {'choices': ['present'], 'default': 'present'}
+}
+
+
 def main():
     module = AnsibleModule(
-        argument_spec={
-            'name':          {'aliases': ['artifact']},
-            'group_id':      {},
-            'artifact_id':   {},
-            'version':       {},
-            'classifier':    {},
-            'extension':     {'default': 'jar'},
-            'repo_url':      {'aliases': ['repo_uri'], 'default': 'http://repo1.maven.org/maven2'},
-            'repo_username': {'aliases': ['username']},
-            'repo_password': {'aliases': ['password'], 'default': ''},
-            'dest':          {'required': True},
-            'state':         {'choices': ['present'], 'default': 'present'}
-        },
-        required_one_of=[['name', 'group_id']],
-        mutually_exclusive=[['name', arg] for arg in ('group_id', 'artifact_id')],
+        argument_spec=ARGUMENT_SPEC,
+        required_one_of=[['name', 'group_id', 'artifacts'], ['dest', 'extract_to']],
+        mutually_exclusive=[['name', 'group_id', 'artifacts'], ['name', 'artifact_id'],
+                            ['artifacts', 'artifact_id']],
         required_together=[['group_id', 'artifact_id']],
         add_file_common_args=True,
         supports_check_mode=True
@@ -336,29 +3043,83 @@ def main():
     # Create type object as namespace for module params
     p = type('Params', (), module.params)
 
+    cache_dir = p.cache_dir and path.expanduser(p.cache_dir)
+    stats = TransferStats(p.stats)
     try:
-        if p.name:
-            artifact = Artifact.parse(p.name)
-            artifact.version = artifact.version or p.version
-            artifact.classifier = artifact.classifier or p.classifier
-            artifact.extension = artifact.extension or p.extension
-        else:
-            artifact = Artifact(p.group_id, p.artifact_id, p.version,
-                                p.classifier, p.extension)
+        dw = make_downloader(module.params, cache_dir, stats, module.check_mode)
+    except OSError, e:
+        module.fail_json(msg="Failed to create cache directory: %s" % e)
+
+    dest = p.dest and path.expanduser(p.dest)
+    extract_to = p.extract_to and path.expanduser(p.extract_to)
+    if extract_to and (p.artifacts or p.resolve_dependencies):
+        module.fail_json(msg="extract_to is supported only for a single artifact")
 
-        dw = MavenDownloader(p.repo_url, p.repo_username, p.repo_password)
-        dest = path.expanduser(p.dest)
+    def finish(method, **result):
+        if p.stats:
+            result['stats'] = stats.summary()
+        method(**result)
 
-        result = dw.download(artifact, dest, module.check_mode)
-        module.exit_json(**result)
+    def set_attributes(result):
+        if not [k for k in FILE_ATTRIBUTES if module.params.get(k) is not None]:
+            return result
+        dest = result.get('path')
+        if result.get('failed') or not dest or not path.exists(dest):
+            return result
+        # a file hard linked by a previous run must not change the one in the store
+        if os.stat(dest).st_nlink > 1 and not module.check_mode:
+            link_or_copy(dest, dest, False)
+        file_args = module.load_file_common_arguments(dict(module.params, path=dest))
+        result['changed'] = module.set_fs_attributes_if_different(file_args, result['changed'])
+        return result
+
+    try:
+        if p.resolve_dependencies:
+            if not path.isdir(dest):
+                module.fail_json(msg="dest must be a directory when resolve_dependencies is enabled")
+
+            pom_cache = MetadataCache(cache_dir and path.join(cache_dir, 'poms'),
+                                      max_entries=10000, readonly=module.check_mode)
+            resolver = DependencyResolver(dw, pom_cache, p.workers)
+            roots = [make_artifact(spec, module.params) for spec in p.artifacts or [module.params]]
+            artifacts = resolver.resolve(roots, p.dependency_scopes)
+            results = map(set_attributes, dw.download_all([(a, dest) for a in artifacts],
+                                                          module.check_mode, p.workers))
+            failed = [r for r in results if r.get('failed')]
+            if failed:
+                finish(module.fail_json, msg="Failed to download %d of %d artifacts"
+                       % (len(failed), len(results)), results=results)
+            finish(module.exit_json, changed=any(r['changed'] for r in results), results=results,
+                   dependencies=[str(a) for a in artifacts[len(roots):]])
+
+        elif p.artifacts:
+            items = [(make_artifact(spec, module.params),
+                      path.expanduser(isinstance(spec, dict) and spec.get('dest') or dest))
+                     for spec in p.artifacts]
+            results = map(set_attributes, dw.download_all(items, module.check_mode, p.workers))
+            failed = [r for r in results if r.get('failed')]
+            if failed:
+                finish(module.fail_json, msg="Failed to download %d of %d artifacts"
+                       % (len(failed), len(results)), results=results)
+            finish(module.exit_json, changed=any(r['changed'] for r in results), results=results)
+        else:
+            artifact = make_artifact(module.params, module.params)
+            if extract_to:
+                result = dw.extract(artifact, extract_to, dest, module.check_mode)
+            else:
+                result = set_attributes(dw.download(artifact, dest, module.check_mode))
+            finish(module.exit_json, **result)
 
     except ArtifactError, e:
-        module.fail_json(msg=str(e), name=str(e.artifact))
+        finish(module.fail_json, msg=str(e), name=str(e.artifact))
     except DownloaderError, e:
-        module.fail_json(msg=str(e), url=str(e.url))
+        finish(module.fail_json, msg=str(e), url=str(e.url))
     except Error, e:
-        module.fail_json(msg=str(e))
+        finish(module.fail_json, msg=str(e))
+    finally:
+        dw.close()
 
 # import module snippets
 from ansible.module_utils.basic import *
-main()
+if __name__ == '__main__':
+    main()
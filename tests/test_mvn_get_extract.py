@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''Tests of extraction of archives by the mvn_get module.
+
+Run with: python -m unittest discover tests
+'''
+import imp
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from os import path
+from StringIO import StringIO
+
+MODULE_PATH = path.join(path.dirname(path.abspath(__file__)),
+                        '..', 'library', 'packaging', 'mvn_get.py')
+
+
+def load_module():
+    '''Loads the mvn_get module without the Ansible boilerplate at its end.
+    '''
+    f = open(MODULE_PATH)
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    module = imp.new_module('mvn_get')
+    module.__file__ = MODULE_PATH
+    source = source[:source.index('# import module snippets')]
+    exec compile(source, MODULE_PATH, 'exec') in module.__dict__
+    return module
+
+mvn_get = load_module()
+
+
+class ExtractTarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dest = path.join(self.tmp, 'dest')
+        self.outside = path.join(self.tmp, 'outside')
+        os.makedirs(self.dest)
+        os.makedirs(self.outside)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_tar(self, members):
+        '''
+        :param members: list of tuples of name and content (a string for
+            a file, or a tuple with the link target for a symlink)
+        '''
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            if isinstance(content, tuple):
+                info.type = tarfile.SYMTYPE
+                info.linkname = content[0]
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, StringIO(content))
+        tar.close()
+        buf.seek(0)
+        return buf
+
+    def extract(self, members):
+        files = {}
+        mvn_get.extract_tar(self.make_tar(members), self.dest, files)
+        return files
+
+    def test_extracts_files_and_internal_links(self):
+        files = self.extract([('a/b.txt', 'hello'), ('a/c.txt', ('b.txt',)),
+                              ('d', ('a',))])
+        self.assertEqual(open(path.join(self.dest, 'a', 'c.txt')).read(), 'hello')
+        self.assertEqual(sorted(files), ['a/b.txt', 'a/c.txt', 'd'])
+
+    def test_rejects_absolute_link_outside(self):
+        self.assertRaises(mvn_get.Error, self.extract, [('link', (self.outside,))])
+        self.assertFalse(path.lexists(path.join(self.dest, 'link')))
+
+    def test_rejects_relative_link_outside(self):
+        self.assertRaises(mvn_get.Error, self.extract, [('a/link', ('../../outside',))])
+
+    def test_rejects_writing_through_existing_link(self):
+        os.symlink(self.outside, path.join(self.dest, 'link'))
+        self.assertRaises(mvn_get.Error, self.extract, [('link/evil.txt', 'evil')])
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_rejects_path_traversal(self):
+        self.assertRaises(mvn_get.Error, self.extract, [('../evil.txt', 'evil')])
+        self.assertEqual(os.listdir(self.outside), [])
+
+
+class ExtractZipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dest = path.join(self.tmp, 'dest')
+        os.makedirs(self.dest)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def extract(self, members):
+        filename = path.join(self.tmp, 'archive.zip')
+        zf = zipfile.ZipFile(filename, 'w')
+        for name, content in members:
+            zf.writestr(name, content)
+        zf.close()
+        files = {}
+        mvn_get.extract_zip(filename, self.dest, files)
+        return files
+
+    def test_extracts_files(self):
+        files = self.extract([('a/', ''), ('a/b.txt', 'hello')])
+        self.assertEqual(open(path.join(self.dest, 'a', 'b.txt')).read(), 'hello')
+        self.assertTrue('a/b.txt' in files)
+
+    def test_rejects_path_traversal(self):
+        self.assertRaises(mvn_get.Error, self.extract, [('../evil.txt', 'evil')])
+        self.assertFalse(path.exists(path.join(self.tmp, 'evil.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()